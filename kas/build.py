@@ -24,17 +24,37 @@
 """
 
 import os
-from .config import Config
-from .libkas import find_program, run_cmd, kasplugin
+import sys
+import logging
+from .config import create_context, ConfigUnion
+from .libkas import find_program, run_cmd, kasplugin, add_job_arguments
+from .libgit import FetchScheduler
 from .libcmds import (Macro, Command, SetupDir, SetupProxy,
                       CleanupSSHAgent, SetupSSHAgent, SetupEnviron,
-                      WriteConfig, SetupHome, ReposFetch,
-                      ReposCheckout)
+                      WriteConfig, SetupHome, ReposLock, BitbakeServer,
+                      add_repos_commands)
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
 
+def get_build_dirs(config_files):
+    """
+        Returns the build directory of each configuration file. A single
+        configuration uses the default build directory, several ones use
+        'build-<name>', with the name of the configuration file.
+    """
+    if len(config_files) == 1:
+        return [None]
+    build_dirs = ['build-' + os.path.splitext(os.path.basename(filename))[0]
+                  for filename in config_files]
+    if len(set(build_dirs)) != len(build_dirs):
+        logging.error('Configuration files built together need different '
+                      'names: %s', ' '.join(config_files))
+        sys.exit(1)
+    return build_dirs
+
+
 @kasplugin
 class Build:
     """
@@ -53,12 +73,22 @@ class Build:
                                     'configuration file.')
 
         bld_psr.add_argument('config',
-                             help='Config file')
+                             nargs='+',
+                             help='Config file. If several are given, their '
+                             'repositories are fetched together and they are '
+                             'built one after another, each in its own '
+                             'build directory')
         bld_psr.add_argument('--target',
                              action='append',
                              help='Select target to build')
         bld_psr.add_argument('--task',
                              help='Select which task should be executed')
+        add_job_arguments(bld_psr)
+        bld_psr.add_argument('--update-lock',
+                             action='store_true',
+                             help='Resolve the refspecs of all repositories '
+                             'and pin them in the lock file next to the '
+                             'configuration file')
         bld_psr.add_argument('--skip',
                              help='Skip build steps',
                              default=[])
@@ -72,31 +102,65 @@ class Build:
         if args.cmd != 'build':
             return False
 
-        cfg = Config(args.config, args.target, args.task)
-
-        macro = Macro()
+        # SetupDir changes into the work directory
+        config_files = [os.path.abspath(filename) for filename in args.config]
+        build_dirs = get_build_dirs(config_files)
+        overrides = {}
+        if args.target:
+            overrides['target'] = args.target
+        if args.task:
+            overrides['task'] = args.task
+        # The SSH agent and the limits of the fetches are set up before the
+        # configurations are loaded, as loading already fetches the
+        # repositories
+        scheduler = FetchScheduler(args.jobs, args.jobs_per_host)
+        setup = Macro()
+        setup.add(SetupDir())
+        setup.add(SetupProxy())
+        if 'SSH_PRIVATE_KEY' in os.environ:
+            setup.add(SetupSSHAgent())
+
+        configs = []
+        for (config_file, build_dir) in zip(config_files, build_dirs):
+            shared_repos = [repo for cfg in configs
+                            for repo in cfg.get_repos()]
+            configs.append(create_context(
+                config_file, build_dir=build_dir,
+                prefetch_repos='repos_fetch' not in args.skip,
+                use_lock=not args.update_lock, shared_repos=shared_repos,
+                scheduler=scheduler,
+                setup=lambda context: setup.run(context, args.skip),
+                **overrides))
 
         # Prepare
-        macro.add(SetupDir())
-        macro.add(SetupProxy())
-
-        if 'SSH_PRIVATE_KEY' in os.environ:
-            macro.add(SetupSSHAgent())
+        for (config_file, cfg) in zip(config_files, configs):
+            macro = Macro()
+            macro.add(ReposLock(config_file, args.update_lock, True,
+                                args.jobs, args.jobs_per_host))
+            macro.run(cfg, args.skip)
+
+        # Loading the configurations only checked out the repositories with
+        # include files. All repositories are checked out here, each one
+        # once, and the fetches that loading started are taken over.
+        macro = Macro()
+        add_repos_commands(macro, args, scheduler)
+        macro.run(ConfigUnion(configs), args.skip)
 
-        macro.add(ReposFetch())
-        macro.add(ReposCheckout())
-        macro.add(SetupEnviron())
+        for cfg in configs:
+            macro = Macro()
+            macro.add(SetupEnviron(args.bb_server_timeout))
 
-        macro.add(WriteConfig())
+            macro.add(WriteConfig())
+            macro.add(SetupHome())
+            macro.add(BitbakeServer())
 
-        # Build
-        macro.add(SetupHome())
-        macro.add(BuildCommand(args.task))
+            # Build
+            macro.add(BuildCommand(args.task))
 
-        if 'SSH_PRIVATE_KEY' in os.environ:
-            macro.add(CleanupSSHAgent())
+            if 'SSH_PRIVATE_KEY' in os.environ:
+                macro.add(CleanupSSHAgent())
 
-        macro.run(cfg, args.skip)
+            macro.run(cfg, args.skip)
 
         return True
 
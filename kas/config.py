@@ -24,8 +24,13 @@
 """
 
 import os
+import sys
+import copy
+import json
+import asyncio
 import logging
 import pprint
+from collections import OrderedDict
 
 try:
     import distro
@@ -49,11 +54,17 @@ except ImportError:
         return platform.dist()[0]
 
 from .repos import Repo
-from .libkas import run_cmd, repos_fetch, repo_checkout
+from .repostate import find_toplevel
+from .libkas import _ensure_future
+from .libgit import (FetchScheduler, _repo_fetch_async,
+                     _repo_checkout_async, exit_on_fetch_checkout_failure,
+                     repo_sparse_dirs)
+from .snapshot import snapshot_restore_async
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
+
 def get_locale_environ():
     """
         Sets the environment variables for process that are
@@ -75,49 +86,71 @@ def get_locale_environ():
                     'No default locales set.', distro_base)
     return {}
 
+
 def get_proxy_environ(os_environ):
-    return {var_name: os_environ.get[var_name]
+    return {var_name: os_environ[var_name]
             for var_name in os_environ.keys() & set(['http_proxy',
                                                      'https_proxy',
                                                      'ftp_proxy',
                                                      'no_proxy'])}
 
+
+def _get_sparse_dirs(layers, includes):
+    """
+        Returns the sorted directories a sparse checkout of a repository
+        needs for its layers and include files, or None if it needs the
+        whole repository.
+    """
+    dirs = set()
+    for layer in layers:
+        layer = os.path.normpath(layer)
+        if layer in ['.', '']:
+            return None
+        dirs.add(layer)
+    if not dirs:
+        return None
+    dirs.update(os.path.dirname(os.path.normpath(include))
+                for include in includes)
+    dirs.discard('')
+    return sorted(dirs)
+
+
 def get_repo_dict(context):
     """
         Returns a dictionary containing the repositories with
         their name (as it is defined in the config file) as key
         and the `Repo` instances as value.
     """
+    # pylint: disable=too-many-locals
     repo_config_dict = context.get_repos_raw()
     repo_dict = {}
     for repo in repo_config_dict:
 
-        repo_config_dict[repo] = repo_config_dict[repo] or {}
-        layers_dict = repo_config_dict[repo].get('layers', {})
+        repo_config = repo_config_dict[repo] or {}
+        layers_dict = repo_config.get('layers', {})
         layers = list(filter(lambda x, laydict=layers_dict:
                              str(laydict[x]).lower() not in
                              ['disabled', 'excluded', 'n', 'no', '0',
                               'false'],
                              layers_dict))
-        url = repo_config_dict[repo].get('url', None)
-        name = repo_config_dict[repo].get('name', repo)
-        refspec = repo_config_dict[repo].get('refspec', None)
-        path = repo_config_dict[repo].get('path', None)
+        url = repo_config.get('url', None)
+        name = repo_config.get('name', repo)
+        refspec = repo_config.get('refspec', None)
+        path = repo_config.get('path', None)
+        sparse = None
+        if repo_config.get('sparse', False):
+            sparse = _get_sparse_dirs(
+                layers, context.get_repo_includes().get(repo, []))
+        # Sparse checkouts only download the files they contain
+        clone = repo_config.get(
+            'clone', 'blobless' if sparse else context.get_repo_clone())
 
         if url is None:
             # No git operation on repository
             if path is None:
                 # In-tree configuration
-                path = os.path.dirname(self.filename)
-                (ret, output) = run_cmd(['git',
-                                         'rev-parse',
-                                         '--show-toplevel'],
-                                        cwd=path,
-                                        env=context.get_environment(),
-                                        fail=False,
-                                        liveupdate=False)
-                if ret == 0:
-                    path = output.strip()
+                path = os.path.dirname(context.filename)
+                path = find_toplevel(path) or path
                 logging.info('Using %s as root for repository %s', path,
                              name)
 
@@ -127,52 +160,235 @@ def get_repo_dict(context):
                        layers=layers)
             rep.disable_git_operations()
         else:
-            path = path or os.path.join(context.kas_work_dir, name)
-            rep = Repo(url=url,
-                       path=path,
-                       refspec=refspec,
-                       layers=layers)
+            locked = context.get_repo_lock().get(repo, {})
+            if locked.get('url') == url and \
+               locked.get('refspec') == refspec and \
+               locked.get('commit'):
+                refspec = locked['commit']
+            repo_args = dict(url=url,
+                             refspec=refspec,
+                             layers=layers,
+                             clone=clone,
+                             sparse=sparse)
+            rep = Repo(path=path or os.path.join(context.kas_work_dir, name),
+                       **repo_args)
+            if path is None:
+                # Configurations that are built together use one checkout
+                # for the same repository and refspec
+                for other in context.get_shared_repos():
+                    if (other.qualified_name, other.refspec) == \
+                       (rep.qualified_name, rep.refspec):
+                        rep = Repo(path=other.path, **repo_args)
+                        break
         repo_dict[repo] = rep
     return repo_dict
 
-def load_configuration_file(context, filepath):
-    from .includehandler import GlobalIncludes, IncludeException
-    filepath = os.path.abspath(filepath)
-    handler = GlobalIncludes(filepath)
 
-    repo_paths = {}
-    missing_repo_names_old = []
-    (config, missing_repo_names) = \
-        handler.get_config(repos=repo_paths)
+def check_repo_conflict(repo, other):
+    """
+        Exits if two configurations that are built together need different
+        repositories or refspecs in the same path.
+    """
+    if repo.path == other.path and \
+       (repo.qualified_name, repo.refspec) != \
+       (other.qualified_name, other.refspec):
+        logging.error('Repository %s is needed with refspec %s and %s by '
+                      'different configurations',
+                      repo.path, repo.refspec, other.refspec)
+        sys.exit(1)
 
-    while missing_repo_names:
-        if missing_repo_names == missing_repo_names_old:
-            raise IncludeException('Could not fetch all repos needed by '
-                                   'includes.')
 
-        logging.debug('Missing repos for complete config:\n%s',
-                      pprint.pformat(missing_repo_names))
+def get_lock_filename(filename):
+    """
+        Returns the path of the lock file that belongs to the configuration
+        file.
+    """
+    return os.path.splitext(filename)[0] + '.lock'
 
-        repo_dict = self.get_repo_dict()
-        missing_repos = [repo_dict[repo_name]
-                         for repo_name in missing_repo_names
-                         if repo_name in repo_dict]
 
-        repos_fetch(self, missing_repos)
+def read_repo_lock(filename):
+    """
+        Returns the locked commits of the repositories from the lock file
+        of the configuration file, or an empty dictionary if it has none.
+    """
+    lock_filename = get_lock_filename(filename)
+    if not os.path.exists(lock_filename):
+        return {}
+    try:
+        with open(lock_filename) as fds:
+            repo_lock = json.load(fds).get('repos', {})
+        if not isinstance(repo_lock, dict):
+            raise ValueError('repos is not a mapping')
+    except (OSError, ValueError, AttributeError) as err:
+        logging.warning('Ignoring lock file %s: %s', lock_filename, err)
+        return {}
+    return repo_lock
+
+
+def load_configuration_file(context, filepath, prepare_repos=True,
+                            prefetch_repos=True, scheduler=None):
+    """
+        Loads the configuration file and its includes into the context.
+
+        Every git repository is fetched as soon as the file that lists it
+        is parsed, while the includes are still being resolved. The
+        repositories that hold include files are checked out as well, and
+        resolution only waits for the ones that contain missing includes.
+        The fetches run through the scheduler, which limits them and keeps
+        the ones that are not done yet for the repos_fetch_checkout step.
+        That step checks out all other repositories, and fetches them if
+        prefetch_repos is False.
+
+        If prepare_repos is False, no git work is done and the includes are
+        read from the existing checkouts.
+    """
+    # pylint: disable=too-many-locals,too-many-statements
+    from .includehandler import GlobalIncludes
+    from .configcache import ConfigCache
+    filepath = os.path.abspath(filepath)
+    handler = GlobalIncludes(filepath, ConfigCache(context.config_cache_dir))
+
+    scheduler = scheduler or FetchScheduler()
+    slots = asyncio.Semaphore(scheduler.jobs)
+    loop = asyncio.get_event_loop()
+    tasks = {}
+
+    @asyncio.coroutine
+    def _fetch(repo):
+        yield from snapshot_restore_async(context, repo)
+        return (yield from _repo_fetch_async(context, repo))
+
+    @asyncio.coroutine
+    def _prepare(repo, previous):
+        # A repo whose settings changed is only prepared again after the
+        # previous task finished, as both use the same path.
+        if previous:
+            yield from asyncio.wait([previous])
+        retc = yield from scheduler.fetch(repo, _fetch, repo)
+        if retc:
+            return ('Fetch', retc)
+        if repo.sparse and os.path.exists(repo.path):
+            # Not all includes are known yet, so only widen an existing
+            # checkout. The repos_fetch_checkout step applies the exact set.
+            current = repo_sparse_dirs(repo)
+            repo = copy.copy(repo)
+            repo.sparse = current and sorted(set(current) | set(repo.sparse))
+        with (yield from slots):
+            retc = yield from _repo_checkout_async(context, repo)
+        return ('Checkout', retc)
+
+    def _is_ready(name):
+        if name in repo_paths:
+            return True
+        task = tasks[name][1] if name in tasks else None
+        return task is not None and task.done() and not task.result()[1]
+
+    repo_paths = {}
 
-        for repo in missing_repos:
-            repo_checkout(self, repo)
+    def _start_repos(missing_repo_names):
+        """
+            Starts fetching the new repositories and preparing the ones
+            with includes, as well as the ones whose settings changed.
+            Returns True if any repository was started to be prepared.
+        """
+        context.set_repo_includes(handler.repo_includes)
+        needed = set(handler.repo_includes) | set(missing_repo_names)
+        started_any = False
+        for (name, repo) in context.get_repo_dict().items():
+            if repo.git_operation_disabled:
+                repo_paths[name] = repo.path
+                continue
+            if not prepare_repos:
+                if name in needed and os.path.exists(repo.path):
+                    repo_paths[name] = repo.path
+                continue
+            if name not in needed and not prefetch_repos:
+                continue
+            for other in context.get_shared_repos():
+                check_repo_conflict(repo, other)
+
+            scheduler.fetch(repo, _fetch, repo)
+            if name not in needed:
+                continue
+
+            (started, previous) = tasks.get(name, (None, None))
+            if started and \
+               (started.url, started.refspec, started.path, started.sparse) \
+               == (repo.url, repo.refspec, repo.path, repo.sparse):
+                continue
+            repo_paths.pop(name, None)
+            tasks[name] = (repo, _ensure_future(_prepare(repo, previous)))
+            started_any = True
+        return started_any
+
+    def _get_config():
+        while True:
+            try:
+                return handler.get_config(repos=repo_paths)
+            except (IOError, OSError):
+                # A new include might be outside of the directories of a
+                # sparse checkout, which is then prepared again.
+                if not _start_repos([]):
+                    raise
+
+    (config, missing_repo_names) = _get_config()
+
+    while True:
+        context.set_config(config)
+        _start_repos(missing_repo_names)
+
+        if not missing_repo_names:
+            break
 
-        repo_paths = {r: repo_dict[r].path for r in repo_dict}
+        logging.debug('Missing repos for complete config:\n%s',
+                      pprint.pformat(missing_repo_names))
 
-        missing_repo_names_old = missing_repo_names
-        (self._config, missing_repo_names) = \
-            self.handler.get_config(repos=repo_paths)
+        while not any(_is_ready(name) for name in missing_repo_names):
+            pending = [tasks[name][1] for name in missing_repo_names
+                       if name in tasks and not tasks[name][1].done()]
+            if not pending:
+                failed = [tasks[name] for name in missing_repo_names
+                          if name in tasks]
+                if failed:
+                    exit_on_fetch_checkout_failure(*zip(*failed))
+                logging.error('Repositories needed by includes are not '
+                              'available: %s', ', '.join(missing_repo_names))
+                sys.exit(1)
+            loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+
+        repo_paths.update({name: tasks[name][0].path for name in tasks
+                           if _is_ready(name)})
+        (config, missing_repo_names) = _get_config()
+
+    # Only the checkouts with includes are waited for. The scheduler hands
+    # the other fetches over to the repos_fetch_checkout step.
+    if tasks:
+        loop.run_until_complete(
+            asyncio.wait([task for (_, task) in tasks.values()]))
+        exit_on_fetch_checkout_failure(*zip(*tasks.values()))
 
     logging.debug('Configuration from config file:\n%s',
-                  pprint.pformat(self._config))
+                  pprint.pformat(config))
+    return context
+
 
-def create_context(filename, os_environ=None, work_dir='', **qwargs):
+def create_context(filename, os_environ=None, work_dir='', build_dir=None,
+                   prepare_repos=True, prefetch_repos=True, use_lock=True,
+                   shared_repos=None, scheduler=None, setup=None, **qwargs):
+    """
+        Creates the context of the configuration file. The commits in its
+        lock file are used, unless use_lock is False. The repositories are
+        fetched through the scheduler while the configuration is loaded,
+        see load_configuration_file. The setup function is called with the
+        context before that, to set up what the fetches need, like the SSH
+        agent. The shared_repos are the repositories of the configurations
+        built together with this one. Further keyword arguments override
+        settings of the configuration.
+    """
+    # pylint: disable=too-many-arguments
+    # The commands change into the work directory
+    filename = os.path.abspath(filename)
     os_environ = os_environ or os.environ
     work_dir = work_dir or os_environ.get('KAS_WORK_DIR', os.getcwd())
 
@@ -180,34 +396,155 @@ def create_context(filename, os_environ=None, work_dir='', **qwargs):
     environ.update(get_proxy_environ(os_environ))
 
     # Preliminary empty context:
-    context = Context(work_dir=work_dir, os_environ=os_environ, environ=environ,
-                      config_override=qwargs)
+    context = Context(work_dir=work_dir, os_environ=os_environ,
+                      environ=environ, config_override=qwargs,
+                      filename=filename, build_dir=build_dir,
+                      shared_repos=shared_repos)
+    if use_lock:
+        context.set_repo_lock(read_repo_lock(filename))
+    if setup:
+        setup(context)
+
+    return load_configuration_file(context, filename, prepare_repos,
+                                   prefetch_repos, scheduler)
+
+
+class ConfigUnion:
+    """
+        The union of several configurations that share the kas work
+        directory. Its repositories are the ones of all configurations, so
+        they can be fetched and checked out at once. Everything else is
+        taken from the first configuration.
+    """
+    def __init__(self, configs):
+        self.configs = configs
+
+    def __getattr__(self, item):
+        return getattr(self.configs[0], item)
+
+    def get_repos(self):
+        """
+            Returns the list of repos of all configurations, each one once.
+            Repos are the same if they have the same qualified name and
+            refspec. Sparse checkouts contain the directories needed by
+            every configuration.
+        """
+        repos = OrderedDict()
+        paths = {}
+        for config in self.configs:
+            for repo in config.get_repos():
+                if repo.path in paths:
+                    check_repo_conflict(paths[repo.path], repo)
+                paths[repo.path] = repo
+                # The configurations use the same path for the same
+                # repository and refspec, unless they set their own
+                key = (repo.qualified_name, repo.refspec, repo.path)
+                other = repos.get(key)
+                if other is None:
+                    repos[key] = repo
+                    continue
+                if other.sparse != repo.sparse:
+                    other = repos[key] = copy.copy(other)
+                    other.sparse = other.sparse and repo.sparse and \
+                        sorted(set(other.sparse) | set(repo.sparse))
+        return list(repos.values())
 
-    context = load_configuration_file(context, filename)
 
 class Context:
     """
         Represents the kas application context.
     """
+    # Commands and plugins query all settings of a configuration from its
+    # context, including the state of its repositories.
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
     def __init__(self, work_dir='', os_environ=None, environ=None, config=None,
-                 config_override=None):
+                 config_override=None, filename=None, build_dir=None,
+                 shared_repos=None):
+        # pylint: disable=too-many-arguments
         self._work_dir = work_dir
+        self._build_dir = build_dir
+        self.filename = filename
         self._os_environ = os_environ or {}
         self._environ = environ or {}
+        # The environment of the processes kas starts, extended by the
+        # commands that set up the build
+        self.environ = dict(self._environ)
+        self.environ['PATH'] = self._os_environ.get('PATH', os.defpath)
 
         self._config_override = config_override or {}
+        self._repo_lock = {}
+        self._repo_includes = {}
+        self._repo_dict = None
+        self._shared_repos = shared_repos or []
         self.set_config(config or {})
 
     def set_config(self, config):
-        self._config = config
+        # The include handler keeps the configuration, so do not modify it
+        self._config = dict(config)
         self._config.update(self._config_override)
+        self._repo_dict = None
+
+    def get_repo_lock(self):
+        """
+            Returns the locked commits of the repositories.
+        """
+        return self._repo_lock
+
+    def set_repo_lock(self, repo_lock):
+        """
+            Sets the locked commits of the repositories, as dictionary that
+            maps the repository id to a dictionary with its 'url', 'refspec'
+            and the 'commit' the refspec resolved to. Locked commits are
+            used instead of the refspec as long as url and refspec of the
+            repository do not change.
+        """
+        self._repo_lock = repo_lock
+        self._repo_dict = None
+
+    def get_repo_includes(self):
+        """
+            Returns the files included from each repository.
+        """
+        return self._repo_includes
+
+    def set_repo_includes(self, repo_includes):
+        """
+            Sets the files included from each repository, as dictionary that
+            maps the repository id to the paths of the files relative to the
+            repository. Sparse checkouts contain the directories of these
+            files.
+        """
+        self._repo_includes = repo_includes
+        self._repo_dict = None
+
+    def get_shared_repos(self):
+        """
+            Returns the repositories of the configurations that are built
+            together with this one.
+        """
+        return self._shared_repos
+
+    def get_proxy_config(self):
+        """
+            Returns the proxy settings from the shell environment.
+        """
+        return get_proxy_environ(self._os_environ)
 
     @property
     def build_dir(self):
         """
-            The path of the build directory.
+            The path of the build directory. It is 'build' in the work
+            directory, unless a different one was given.
+        """
+        return os.path.join(self._work_dir, self._build_dir or 'build')
+
+    @property
+    def config_cache_dir(self):
+        """
+            The path of the directory that caches parsed configuration files.
         """
-        return os.path.join(self._work_dir, 'build')
+        return os.path.join(self._work_dir, '.kas-cache', 'config')
 
     @property
     def kas_work_dir(self):
@@ -224,6 +561,50 @@ class Context:
 
         return self._os_environ.get('KAS_REPO_REF_DIR', None)
 
+    def get_repo_snapshot_dir(self):
+        """
+            The path to the directory that contains the snapshots of
+            repositories or None.
+        """
+        return self._os_environ.get('KAS_REPO_SNAPSHOT_DIR', None)
+
+    def _get_os_environ_flag(self, name):
+        return self._os_environ.get(name, '0').lower() \
+            not in ['', '0', 'n', 'no', 'false']
+
+    def get_repo_ref_dissociate(self):
+        """
+            Returns True if checkouts should not borrow objects from the
+            repository reference directory after they are cloned.
+        """
+        return self._get_os_environ_flag('KAS_REPO_REF_DISSOCIATE')
+
+    def get_repo_ref_worktree(self):
+        """
+            Returns True if checkouts should be created as worktrees of the
+            mirrors in the repository reference directory.
+        """
+        return self._get_os_environ_flag('KAS_REPO_REF_WORKTREE')
+
+    def get_repo_clone(self):
+        """
+            The default clone strategy of repositories, that do not define
+            their own.
+        """
+        clone = self._os_environ.get('KAS_REPO_CLONE', 'full')
+        if clone not in ['full', 'shallow', 'blobless', 'treeless']:
+            logging.warning('Unknown clone strategy "%s" in KAS_REPO_CLONE, '
+                            'using full clones', clone)
+            return 'full'
+        return clone
+
+    def get_build_environ_refresh(self):
+        """
+            Returns True if the build environment should be created by the
+            init script again, even if the stored one is still valid.
+        """
+        return self._get_os_environ_flag('KAS_BUILD_ENV_REFRESH')
+
     def get_environment(self):
         """
             Returns the context environment variables from the configuration,
@@ -237,12 +618,20 @@ class Context:
     def get_repos_raw(self):
         return self._config.get('repos', {})
 
+    def get_repo_dict(self):
+        """
+            Returns the repos by their name in the configuration. They are
+            only created again after the configuration, the repo lock or
+            the repo includes changed.
+        """
+        if self._repo_dict is None:
+            self._repo_dict = get_repo_dict(self)
+        return self._repo_dict
+
     def get_repos(self):
         """
             Returns the list of repos.
         """
-        # pylint: disable=no-self-use
-
         return list(self.get_repo_dict().values())
 
     def get_bitbake_targets(self):
@@ -305,10 +694,10 @@ class Context:
         """
             Returns the multiconfig array as bitbake string
         """
-        return ' '.join(set(i.split(':')[1]
-                            for i in
-                            self.get_bitbake_targets()
-                            if i.startswith('multiconfig')))
+        return ' '.join(sorted(set(i.split(':')[1]
+                                   for i in
+                                   self.get_bitbake_targets()
+                                   if i.startswith('multiconfig'))))
 
     def get_gitlabci_config(self):
         """
@@ -0,0 +1,108 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module implements a cache of parsed and validated configuration
+    files, so that unchanged files skip the parser and the schema validation.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+
+from . import __version__, __file_version__, __compatible_file_version__
+from . import CONFIGSCHEMA
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+class ConfigCache:
+    """
+        Stores the parsed and validated content of configuration files in
+        the cache directory, one entry per path. An entry is only used as
+        long as the hash of the file content matches, and neither kas nor
+        its configuration schema changed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._entries = {}
+        schema = json.dumps(CONFIGSCHEMA, sort_keys=True)
+        self._salt = '{}:{}:{}:{}:'.format(
+            __version__, __file_version__, __compatible_file_version__,
+            hashlib.sha256(schema.encode('utf-8')).hexdigest()
+        ).encode('utf-8')
+
+    def _key(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return hashlib.sha256(self._salt + content).hexdigest()
+
+    def _entry_file(self, filename):
+        path = os.path.abspath(filename).encode('utf-8')
+        return os.path.join(self.directory,
+                            hashlib.sha256(path).hexdigest() + '.pickle')
+
+    def get(self, filename, content):
+        """
+            Returns the cached configuration of the file with the content or
+            None.
+        """
+        # pylint: disable=broad-except
+        key = self._key(content)
+        try:
+            entry = self._entries.get(filename)
+            if entry is None:
+                with open(self._entry_file(filename), 'rb') as fds:
+                    entry = pickle.load(fds)
+                self._entries[filename] = entry
+            if entry['key'] != key:
+                return None
+            # Unpickle a fresh copy, callers may modify the configuration
+            return pickle.loads(entry['config'])
+        except Exception:
+            # Unpickling a missing, truncated or foreign entry can fail in
+            # many ways, which all mean that the entry is not usable
+            self._entries.pop(filename, None)
+            return None
+
+    def put(self, filename, content, config):
+        """
+            Stores the configuration of the file with the content.
+        """
+        entry = {'key': self._key(content),
+                 'config': pickle.dumps(config, pickle.HIGHEST_PROTOCOL)}
+        self._entries[filename] = entry
+        entry_file = self._entry_file(filename)
+        tmpfile = '{}.{}.{}.tmp'.format(entry_file, os.getpid(),
+                                        threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpfile, 'wb') as fds:
+                pickle.dump(entry, fds, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, entry_file)
+        except (IOError, OSError) as err:
+            logging.debug('Could not write config cache %s: %s',
+                          entry_file, err)
@@ -120,6 +120,14 @@ CONFIGSCHEMA = {
                             'path': {
                                 'type': 'string',
                             },
+                            'clone': {
+                                'type': 'string',
+                                'enum': ['full', 'shallow', 'blobless',
+                                         'treeless'],
+                            },
+                            'sparse': {
+                                'type': 'boolean',
+                            },
                             'layers': {
                                 'type': 'object',
                                 'additionalProperties': {
@@ -179,3 +187,158 @@ CONFIGSCHEMA = {
         },
     },
 }
+
+
+class _UnsupportedSchema(Exception):
+    """
+        The schema uses a keyword the compiler does not support.
+    """
+
+
+def _is_integer(instance):
+    return isinstance(instance, int) and not isinstance(instance, bool)
+
+
+def _is_number(instance):
+    return isinstance(instance, (int, float)) and \
+        not isinstance(instance, bool)
+
+
+# The JSON types as the Draft 4 validator of jsonschema checks them
+_TYPES = {
+    'object': lambda instance: isinstance(instance, dict),
+    'array': lambda instance: isinstance(instance, list),
+    'string': lambda instance: isinstance(instance, str),
+    'integer': _is_integer,
+    'number': _is_number,
+    'boolean': lambda instance: isinstance(instance, bool),
+    'null': lambda instance: instance is None,
+}
+
+
+def _compile_type(types):
+    if isinstance(types, str):
+        types = [types]
+    checks = [_TYPES[name] for name in types]
+    return lambda instance: any(check(instance) for check in checks)
+
+
+def _compile_enum(values):
+    if any(isinstance(value, (bool, int, float)) for value in values):
+        raise _UnsupportedSchema('enum with numbers or booleans')
+    return lambda instance: not isinstance(instance, (bool, int, float)) \
+        and instance in values
+
+
+def _compile_properties(properties):
+    checks = [(name, _compile(schema))
+              for (name, schema) in properties.items()]
+
+    def _check(instance):
+        if not isinstance(instance, dict):
+            return True
+        return all(check(instance[name])
+                   for (name, check) in checks if name in instance)
+    return _check
+
+
+def _compile_additional_properties(additional, known):
+    known = set(known)
+    if additional is True:
+        return None
+    if additional is False:
+        return lambda instance: not isinstance(instance, dict) or \
+            all(name in known for name in instance)
+    check = _compile(additional)
+    return lambda instance: not isinstance(instance, dict) or \
+        all(check(value) for (name, value) in instance.items()
+            if name not in known)
+
+
+def _compile_required(names):
+    return lambda instance: not isinstance(instance, dict) or \
+        all(name in instance for name in names)
+
+
+def _compile_items(items):
+    if not isinstance(items, dict):
+        raise _UnsupportedSchema('items as list of schemas')
+    check = _compile(items)
+    return lambda instance: not isinstance(instance, list) or \
+        all(check(item) for item in instance)
+
+
+def _compile_one_of(schemas):
+    checks = [_compile(schema) for schema in schemas]
+    types = [schema.get('type') for schema in schemas]
+    if all(isinstance(name, str) for name in types) and \
+       len(set(types)) == len(types) and \
+       not set(['integer', 'number']) <= set(types):
+        # The types exclude each other, so only the branch with the
+        # matching type can be valid
+        branches = [(_TYPES[name], check)
+                    for (name, check) in zip(types, checks)]
+
+        def _check_branch(instance):
+            for (type_check, check) in branches:
+                if type_check(instance):
+                    return check(instance)
+            return False
+        return _check_branch
+
+    return lambda instance: \
+        sum(1 for check in checks if check(instance)) == 1
+
+
+def _compile(schema):
+    """
+        Compiles the schema into a function that returns True for valid
+        instances. Raises _UnsupportedSchema for schema keywords it
+        does not support.
+    """
+    checks = []
+    for (keyword, value) in schema.items():
+        if keyword == 'type':
+            checks.append(_compile_type(value))
+        elif keyword == 'enum':
+            checks.append(_compile_enum(value))
+        elif keyword == 'properties':
+            checks.append(_compile_properties(value))
+        elif keyword == 'additionalProperties':
+            checks.append(_compile_additional_properties(
+                value, schema.get('properties', {})))
+        elif keyword == 'required':
+            checks.append(_compile_required(value))
+        elif keyword == 'items':
+            checks.append(_compile_items(value))
+        elif keyword == 'oneOf':
+            checks.append(_compile_one_of(value))
+        else:
+            raise _UnsupportedSchema(keyword)
+    checks = [check for check in checks if check]
+    if len(checks) == 1:
+        return checks[0]
+    return lambda instance: all(check(instance) for check in checks)
+
+
+_VALIDATORS = {}
+
+
+def get_validator(schema):
+    """
+        Returns a function that returns True if an instance is valid
+        according to the Draft 4 schema, compiled once per schema, or None
+        if the schema uses keywords the compiler does not support.
+
+        The function only answers whether the instance is valid. Use the
+        jsonschema validator to report the errors of invalid instances.
+    """
+    # Keep a reference to the schema, so its id is not reused
+    (cached_schema, validator) = _VALIDATORS.get(id(schema), (None, None))
+    if cached_schema is not schema:
+        try:
+            validator = _compile(schema)
+        except _UnsupportedSchema:
+            validator = None
+        _VALIDATORS[id(schema)] = (schema, validator)
+    return validator
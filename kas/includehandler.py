@@ -27,18 +27,21 @@
 
 import os
 from collections import OrderedDict, Mapping
-import functools
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
-from jsonschema.validators import Draft4Validator
-
 from . import __file_version__, __compatible_file_version__
 from . import CONFIGSCHEMA
+from .configschema import get_validator
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
 
+# The number of include files read and parsed at the same time
+LOAD_THREADS = 4
+
+
 class LoadConfigException(Exception):
     """
         Class for exceptions that appear while loading the configuration file.
@@ -47,34 +50,91 @@ class LoadConfigException(Exception):
         super().__init__('{}: {}'.format(message, filename))
 
 
-def load_config(filename):
+def _yaml_parser():
+    import yaml
+    try:
+        # PyYAML built with the libyaml C library
+        loader = yaml.CSafeLoader
+        name = 'libyaml'
+    except AttributeError:
+        loader = yaml.SafeLoader
+        name = 'PyYAML'
+    return (name, lambda content: yaml.load(content, Loader=loader))
+
+
+def _json_parser():
+    import json
+
+    def parse_json(content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return json.loads(content)
+
+    try:
+        import orjson
+    except ImportError:
+        return ('json', parse_json)
+
+    def parse_orjson(content):
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # json accepts a few things orjson does not, like NaN, and
+            # reports errors the way users know them
+            return parse_json(content)
+    return ('orjson', parse_orjson)
+
+
+_PARSERS = {}
+
+
+def get_parser(ext):
+    """
+        Returns the name of the fastest available parser for configuration
+        files with the extension and a function that parses their content.
+    """
+    if ext not in _PARSERS:
+        _PARSERS[ext] = _json_parser() if ext == '.json' else _yaml_parser()
+        logging.debug('Using %s to parse %s files', _PARSERS[ext][0], ext)
+    return _PARSERS[ext]
+
+
+def load_config(filename, cache=None):
     """
         Load the configuration file and test if version is supported.
+        If a cache is given, files that are unchanged since they were last
+        loaded are neither parsed nor validated again.
     """
     (_, ext) = os.path.splitext(filename)
-    config = None
-    if ext == '.json':
-        import json
-        with open(filename, 'rb') as fds:
-            config = json.load(fds)
-    elif ext == '.yml':
-        import yaml
-        with open(filename, 'rb') as fds:
-            config = yaml.safe_load(fds)
-    else:
+    if ext not in ['.json', '.yml']:
         raise LoadConfigException('Config file extension not recognized',
                                   filename)
 
-    validator = Draft4Validator(CONFIGSCHEMA)
-    validation_error = False
+    with open(filename, 'rb') as fds:
+        content = fds.read()
 
-    for error in validator.iter_errors(config):
-        validation_error = True
-        logging.error('Config file validation Error:\n%s', error)
+    if cache:
+        config = cache.get(filename, content)
+        if config is not None:
+            return config
 
-    if validation_error:
-        raise LoadConfigException('Errors occured while validating the '
-                                  'config file %s', filename)
+    (_, parse) = get_parser(ext)
+    config = parse(content)
+
+    is_valid = get_validator(CONFIGSCHEMA)
+    if not is_valid or not is_valid(config):
+        # Let jsonschema find the errors and report them
+        from jsonschema.validators import Draft4Validator
+        validator = Draft4Validator(CONFIGSCHEMA)
+        validation_error = False
+
+        for error in validator.iter_errors(config):
+            validation_error = True
+            logging.error('Config file validation Error:\n%s', error)
+
+        if validation_error:
+            raise LoadConfigException('Errors occured while validating the '
+                                      'config file %s', filename)
 
     try:
         version_value = int(config['header']['version'])
@@ -92,9 +152,41 @@ def load_config(filename):
                                           __file_version__, version_value),
                                   filename)
 
+    if cache:
+        cache.put(filename, content, config)
+
     return config
 
 
+def _file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class _IncludeNode:
+    """
+        The expansion of a configuration file into the sequence of
+        configurations to merge, together with what it depends on.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.signature = _file_signature(filename)
+        self.config = None
+        # The configurations to merge and the missing repositories, as
+        # returned by the include handler
+        self.expansion = ([], [])
+        # The paths of the repositories included directly, the repositories
+        # directly included but missing and the files included directly
+        self.repo_paths = {}
+        self.repos_missing = set()
+        self.children = []
+
+
 class IncludeException(Exception):
     """
         Class for exceptions that appear in the include mechanism.
@@ -102,6 +194,47 @@ class IncludeException(Exception):
     pass
 
 
+def merge_configs(configs, base=None):
+    """
+        Merges the configurations recursively from left to right, like
+        repeatedly merging each of them into a copy of the result so far,
+        but in a single pass.
+
+        The mappings of the result are only copied when they are modified
+        for the first time, after that they are updated in place. Values not
+        modified are shared with the configurations, which are never
+        modified themselves. If base is given, the configurations are merged
+        into it.
+    """
+    # The mappings created during this merge, by their id
+    owned = {}
+
+    def _merge(dest, upd):
+        if id(dest) not in owned:
+            dest = OrderedDict(dest)
+            owned[id(dest)] = dest
+        for (key, val) in upd.items():
+            dest_subkey = dest.get(key)
+            if isinstance(dest_subkey, Mapping) and isinstance(val, Mapping):
+                dest[key] = _merge(dest_subkey, val)
+            else:
+                dest[key] = val
+        return dest
+
+    configs = list(configs)
+    if base is None:
+        if len(configs) < 2:
+            return configs[0] if configs else OrderedDict()
+        (base, configs) = (configs[0], configs[1:])
+    if not isinstance(base, Mapping):
+        raise IncludeException('Cannot merge using non-dict')
+    for config in configs:
+        if not isinstance(config, Mapping):
+            raise IncludeException('Cannot merge using non-dict')
+        base = _merge(base, config)
+    return base
+
+
 class IncludeHandler(object):
     """
         Abstract class that defines the interface of an include handler.
@@ -143,10 +276,84 @@ class GlobalIncludes(IncludeHandler):
         current config file otherwise its relative to the repository path.
 
         The includes are read and merged depth first from top to buttom.
+
+        The files included from repositories are collected in repo_includes,
+        that maps the repository key to the set of its included files.
     """
 
+    def __init__(self, top_file, cache=None):
+        super().__init__(top_file)
+        self.cache = cache
+        self.repo_includes = {}
+        # The expanded includes of every file, kept between calls. A file is
+        # read once, even if it is included several times, and only expanded
+        # again if it, or an include it depends on, changed.
+        self._expanded = {}
+        # The configurations last merged and the result
+        self._merged = ([], None)
+
     def get_config(self, repos=None):
+        # pylint: disable=too-many-statements,too-many-branches
         repos = repos or {}
+        chain = []
+        valid = {}
+        # The files being loaded in the background, by their real path
+        loading = {}
+
+        def _is_valid(key):
+            if key not in valid:
+                node = self._expanded.get(key)
+                valid[key] = node is not None and \
+                    _file_signature(node.filename) == node.signature and \
+                    all(repos.get(repo) == path
+                        for (repo, path) in node.repo_paths.items()) and \
+                    not any(repo in repos for repo in node.repos_missing) and \
+                    all(_is_valid(child) for child in node.children)
+            return valid[key]
+
+        def _include_handler(filename):
+            key = os.path.realpath(filename)
+            if key in chain:
+                cycle = chain[chain.index(key):] + [key]
+                raise IncludeException('Include cycle detected: {}'
+                                       .format(' -> '.join(cycle)))
+            if not _is_valid(key):
+                chain.append(key)
+                try:
+                    self._expanded[key] = _internal_include_handler(filename)
+                finally:
+                    chain.pop()
+                valid[key] = True
+            return self._expanded[key].expansion
+
+        def _load_includes(filename, includes):
+            """
+            Starts loading the files included by filename in the background,
+            unless they were loaded before. They are still expanded and
+            merged in order, errors are raised when the file is expanded.
+            """
+            for include in includes:
+                if isinstance(include, str):
+                    includefile = include
+                    if not include.startswith(os.path.pathsep):
+                        includefile = os.path.join(os.path.dirname(filename),
+                                                   include)
+                elif isinstance(include, Mapping) and \
+                        include.get('repo') in repos and 'file' in include:
+                    includefile = os.path.join(repos[include['repo']],
+                                               include['file'])
+                else:
+                    continue
+                key = os.path.realpath(includefile)
+                if key in loading or key in chain or _is_valid(key):
+                    continue
+                previous = self._expanded.get(key)
+                if previous and \
+                        previous.signature == _file_signature(includefile):
+                    continue
+                loading[key] = executor.submit(load_config,
+                                               os.path.abspath(includefile),
+                                               self.cache)
 
         def _internal_include_handler(filename):
             """
@@ -174,13 +381,24 @@ class GlobalIncludes(IncludeHandler):
             the current file overwrites every include. (evaluation depth first
             and from top to buttom)
             """
+            node = _IncludeNode(filename)
             missing_repos = []
             configs = []
-            current_config = load_config(filename)
+            previous = self._expanded.get(os.path.realpath(filename))
+            if previous and previous.signature == node.signature:
+                # Only its includes changed
+                current_config = previous.config
+            elif os.path.realpath(filename) in loading:
+                current_config = \
+                    loading.pop(os.path.realpath(filename)).result()
+            else:
+                current_config = load_config(filename, self.cache)
+            node.config = current_config
             if not isinstance(current_config, Mapping):
                 raise IncludeException('Configuration file does not contain a '
                                        'dictionary as base type')
             header = current_config.get('header', {})
+            _load_includes(filename, header.get('includes', []))
 
             for include in header.get('includes', []):
                 if isinstance(include, str):
@@ -192,13 +410,17 @@ class GlobalIncludes(IncludeHandler):
                             os.path.join(
                                 os.path.dirname(filename),
                                 include))
-                    (cfg, rep) = _internal_include_handler(includefile)
+                    (cfg, rep) = _include_handler(includefile)
+                    node.children.append(os.path.realpath(includefile))
                     configs.extend(cfg)
                     missing_repos.extend(rep)
                 elif isinstance(include, Mapping):
                     includerepo = include.get('repo', None)
                     if includerepo is not None:
                         includedir = repos.get(includerepo, None)
+                        if 'file' in include:
+                            self.repo_includes.setdefault(
+                                includerepo, set()).add(include['file'])
                     else:
                         raise IncludeException(
                             '"repo" is not specified: {}'
@@ -210,59 +432,37 @@ class GlobalIncludes(IncludeHandler):
                             raise IncludeException(
                                 '"file" is not specified: {}'
                                 .format(include))
-                        (cfg, rep) = _internal_include_handler(
-                            os.path.abspath(
-                                os.path.join(
-                                    includedir,
-                                    includefile)))
+                        includefile = os.path.abspath(
+                            os.path.join(includedir, includefile))
+                        (cfg, rep) = _include_handler(includefile)
+                        node.children.append(os.path.realpath(includefile))
+                        node.repo_paths[includerepo] = includedir
                         configs.extend(cfg)
                         missing_repos.extend(rep)
                     else:
+                        node.repos_missing.add(includerepo)
                         missing_repos.append(includerepo)
             configs.append((filename, current_config))
             # Remove all possible duplicates in missing_repos
-            missing_repos = list(OrderedDict.fromkeys(missing_repos))
-            return (configs, missing_repos)
+            node.expansion = (configs,
+                              list(OrderedDict.fromkeys(missing_repos)))
+            return node
 
-        def _internal_dict_merge(dest, upd, recursive_merge=True):
-            """
-            Merges upd recursively into a copy of dest as OrderedDict
-
-            If recursive_merge=False, will use the classic dict.update,
-            or fall back on a manual merge (helpful for non-dict types
-            like FunctionWrapper)
-            """
-            if (not isinstance(dest, Mapping)) \
-                    or (not isinstance(upd, Mapping)):
-                raise IncludeException('Cannot merge using non-dict')
-            dest = OrderedDict(dest)
-            updkeys = list(upd.keys())
-            if not set(list(dest.keys())) & set(updkeys):
-                recursive_merge = False
-            if recursive_merge:
-                for key in updkeys:
-                    val = upd[key]
-                    try:
-                        dest_subkey = dest.get(key, None)
-                    except AttributeError:
-                        dest_subkey = None
-                    if isinstance(dest_subkey, Mapping) \
-                            and isinstance(val, Mapping):
-                        ret = _internal_dict_merge(dest_subkey, val)
-                        dest[key] = ret
-                    else:
-                        dest[key] = upd[key]
-                return dest
+        with ThreadPoolExecutor(max_workers=LOAD_THREADS) as executor:
             try:
-                for k in upd:
-                    dest[k] = upd[k]
-            except AttributeError:
-                # this mapping is not a dict
-                for k in upd:
-                    dest[k] = upd[k]
-            return dest
-
-        configs, missing_repos = _internal_include_handler(self.top_file)
-        config = functools.reduce(_internal_dict_merge,
-                                  map(lambda x: x[1], configs))
+                configs, missing_repos = _include_handler(self.top_file)
+            finally:
+                for future in loading.values():
+                    future.cancel()
+        configs = [config for (_, config) in configs]
+
+        # Continue from the result of the last call, if the configurations
+        # merged then are still the first ones to merge
+        (merged_configs, config) = self._merged
+        if merged_configs and len(merged_configs) <= len(configs) and \
+                all(old is new for (old, new) in zip(merged_configs, configs)):
+            config = merge_configs(configs[len(merged_configs):], config)
+        else:
+            config = merge_configs(configs)
+        self._merged = (configs, config)
         return config, missing_repos
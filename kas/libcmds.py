@@ -25,14 +25,47 @@
 
 import tempfile
 import logging
+import hashlib
 import shutil
+import json
 import os
 from .libkas import (ssh_cleanup_agent, ssh_setup_agent, ssh_no_host_key_check,
-                     get_build_environ, repos_fetch, repo_checkout)
+                     get_build_environ, find_program, run_cmd)
+from .libgit import (repos_fetch, repos_checkout, repos_fetch_checkout,
+                     repos_resolve)
+from .snapshot import snapshots_restore, snapshots_store
+from .config import get_lock_filename, read_repo_lock
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
+# The variables bitbake takes from its environment, besides the ones named
+# in the variables of BITBAKE_ENVIRON_LISTS
+BITBAKE_ENVIRON = ['BBPATH', 'BUILDDIR', 'HOME', 'LANG', 'LC_ALL', 'LOGNAME',
+                   'PATH', 'SHELL', 'USER', 'BB_PRESERVE_ENV']
+BITBAKE_ENVIRON_LISTS = ['BB_ENV_WHITELIST', 'BB_ENV_EXTRAWHITE',
+                         'BB_ENV_PASSTHROUGH', 'BB_ENV_PASSTHROUGH_ADDITIONS']
+
+
+def _write_if_changed(filename, content):
+    """
+        Replaces the file atomically with the content, unless it already
+        has this content, so that its modification time only changes with
+        the content. Returns True if the file was written.
+    """
+    content = content.encode('utf-8')
+    try:
+        with open(filename, 'rb') as fds:
+            if fds.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as fds:
+        fds.write(content)
+    os.replace(tmpfile, filename)
+    return True
+
 
 class Macro:
     """
@@ -74,25 +107,34 @@ class Command:
 
 class SetupHome(Command):
     """
-        Setups the home directory of kas.
+        Setups the home directory of kas. A memory resident bitbake server
+        keeps using the home directory it was started with, so if
+        BB_SERVER_TIMEOUT is set, the home directory is kept in the build
+        directory. Otherwise a temporary one is used.
     """
 
     def __init__(self):
         super().__init__()
-        self.tmpdirname = tempfile.mkdtemp()
+        self.tmpdirname = None
 
     def __del__(self):
-        shutil.rmtree(self.tmpdirname)
+        if self.tmpdirname:
+            shutil.rmtree(self.tmpdirname)
 
     def __str__(self):
         return 'setup_home'
 
     def execute(self, config):
-        with open(self.tmpdirname + '/.wgetrc', 'w') as fds:
-            fds.write('\n')
-        with open(self.tmpdirname + '/.netrc', 'w') as fds:
-            fds.write('\n')
-        config.environ['HOME'] = self.tmpdirname
+        if 'BB_SERVER_TIMEOUT' in config.environ:
+            home = os.path.join(config.build_dir, '.kas-home')
+            os.makedirs(home, exist_ok=True)
+        else:
+            if not self.tmpdirname:
+                self.tmpdirname = tempfile.mkdtemp()
+            home = self.tmpdirname
+        for name in ['.wgetrc', '.netrc']:
+            _write_if_changed(os.path.join(home, name), '\n')
+        config.environ['HOME'] = home
 
 
 class SetupDir(Command):
@@ -151,43 +193,177 @@ class SetupEnviron(Command):
         Setups the kas environment.
     """
 
+    def __init__(self, bb_server_timeout=None):
+        super().__init__()
+        self.bb_server_timeout = bb_server_timeout
+
     def __str__(self):
         return 'setup_environ'
 
     def execute(self, config):
         config.environ.update(get_build_environ(config, config.build_dir))
+        if self.bb_server_timeout is not None:
+            config.environ['BB_SERVER_TIMEOUT'] = \
+                str(self.bb_server_timeout)
 
 
 class WriteConfig(Command):
     """
-        Writes bitbake configuration files into the build directory.
+        Writes bitbake configuration files into the build directory. Files
+        that already have the right content are not touched, so bitbake
+        does not parse its configuration again.
     """
 
     def __str__(self):
         return 'write_config'
 
     def execute(self, config):
-        def _write_bblayers_conf(config):
-            filename = config.build_dir + '/conf/bblayers.conf'
-            with open(filename, 'w') as fds:
-                fds.write(config.get_bblayers_conf_header())
-                fds.write('BBLAYERS ?= " \\\n    ')
-                fds.write(' \\\n    '.join(
+        def _get_bblayers_conf(config):
+            return ''.join([
+                config.get_bblayers_conf_header(),
+                'BBLAYERS ?= " \\\n    ',
+                ' \\\n    '.join(
                     sorted(layer for repo in config.get_repos()
-                           for layer in repo.layers)))
-                fds.write('"\n')
+                           for layer in repo.layers)),
+                '"\n'])
+
+        def _get_local_conf(config):
+            return ''.join([
+                config.get_local_conf_header(),
+                'MACHINE ?= "{}"\n'.format(config.get_machine()),
+                'DISTRO ?= "{}"\n'.format(config.get_distro()),
+                'BBMULTICONFIG ?= "{}"\n'.format(config.get_multiconfig())])
+
+        for (name, content) in [('bblayers.conf', _get_bblayers_conf(config)),
+                                ('local.conf', _get_local_conf(config))]:
+            filename = os.path.join(config.build_dir, 'conf', name)
+            if _write_if_changed(filename, content):
+                logging.info('Wrote %s', filename)
+            else:
+                logging.debug('%s is unchanged', filename)
+
+
+class BitbakeServer(Command):
+    """
+        Stops a memory resident bitbake server of the build directory, if
+        it was started for a different configuration or environment. Later
+        bitbake calls then start a new one. A server stays in memory after
+        bitbake exits if BB_SERVER_TIMEOUT is set.
+
+        Only the variables bitbake takes from the environment are compared.
+        SSH_AUTH_SOCK and SSH_AGENT_PID are left out even if they are passed
+        to bitbake, as every kas call with SSH_PRIVATE_KEY starts a new
+        ssh-agent.
+    """
 
-        def _write_local_conf(config):
-            filename = config.build_dir + '/conf/local.conf'
-            with open(filename, 'w') as fds:
-                fds.write(config.get_local_conf_header())
-                fds.write('MACHINE ?= "{}"\n'.format(config.get_machine()))
-                fds.write('DISTRO ?= "{}"\n'.format(config.get_distro()))
-                fds.write('BBMULTICONFIG ?= "{}"\n'.format(
-                    config.get_multiconfig()))
+    def __str__(self):
+        return 'bitbake_server'
+
+    @staticmethod
+    def _get_fingerprint(config):
+        names = set(BITBAKE_ENVIRON)
+        for name in BITBAKE_ENVIRON_LISTS:
+            names.update(config.environ.get(name, '').split())
+            names.add(name)
+        names -= set(['SSH_AUTH_SOCK', 'SSH_AGENT_PID'])
+        environ = {name: config.environ[name] for name in names
+                   if name in config.environ}
+
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(environ, sort_keys=True).encode('utf-8'))
+        for name in ['bblayers.conf', 'local.conf']:
+            try:
+                with open(os.path.join(config.build_dir, 'conf', name),
+                          'rb') as fds:
+                    hasher.update(fds.read())
+            except (IOError, OSError):
+                pass
+        return hasher.hexdigest()
 
-        _write_bblayers_conf(config)
-        _write_local_conf(config)
+    def execute(self, config):
+        filename = os.path.join(config.build_dir, '.kas-bitbake-server')
+        try:
+            with open(filename) as fds:
+                stored = fds.read().strip()
+        except (IOError, OSError):
+            stored = None
+
+        if 'BB_SERVER_TIMEOUT' not in config.environ:
+            # Without a timeout, only servers started by earlier calls may
+            # be running
+            if stored is not None:
+                self._stop(config)
+                os.remove(filename)
+            return
+
+        fingerprint = self._get_fingerprint(config)
+        if stored != fingerprint:
+            self._stop(config)
+        _write_if_changed(filename, fingerprint + '\n')
+
+    @staticmethod
+    def _stop(config):
+        if not os.path.exists(os.path.join(config.build_dir, 'bitbake.lock')):
+            return
+        path = config.environ.get('PATH', os.environ['PATH'])
+        bitbake = find_program(path, 'bitbake')
+        if bitbake:
+            logging.info('Configuration changed, stopping the bitbake server')
+            run_cmd([bitbake, '-m'], env=config.environ,
+                    cwd=config.build_dir, fail=False)
+
+
+class ReposLock(Command):
+    """
+        Pins the repositories to the commits recorded in the lock file next
+        to the configuration file. On update, and if create is set and
+        there is no lock file yet, the refspecs of all repositories are
+        resolved and written to the lock file first.
+    """
+
+    def __init__(self, config_file, update=False, create=False, jobs=None,
+                 jobs_per_host=None):
+        # pylint: disable=too-many-arguments
+        super().__init__()
+        self.config_file = config_file
+        self.filename = get_lock_filename(config_file)
+        self.update = update
+        self.create = create
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+
+    def __str__(self):
+        return 'repos_lock'
+
+    def execute(self, config):
+        exists = os.path.exists(self.filename)
+        if self.update or (self.create and not exists):
+            config.set_repo_lock({})
+            repo_dict = config.get_repo_dict()
+            commits = repos_resolve(config, repo_dict,
+                                    self.jobs, self.jobs_per_host)
+            repo_lock = {name: {'url': repo_dict[name].url,
+                                'refspec': repo_dict[name].refspec,
+                                'commit': commit}
+                         for (name, commit) in commits.items()}
+            tmpfile = self.filename + '.tmp'
+            try:
+                with open(tmpfile, 'w') as fds:
+                    json.dump({'repos': repo_lock}, fds, indent=4,
+                              sort_keys=True)
+                    fds.write('\n')
+                os.replace(tmpfile, self.filename)
+                logging.info('Lock file %s written', self.filename)
+            except OSError as err:
+                logging.warning('Could not write lock file %s: %s',
+                                self.filename, err)
+        elif exists:
+            repo_lock = read_repo_lock(self.config_file)
+            logging.info('Using lock file %s', self.filename)
+        else:
+            return
+
+        config.set_repo_lock(repo_lock)
 
 
 class ReposFetch(Command):
@@ -195,11 +371,18 @@ class ReposFetch(Command):
         Fetches repositories defined in the configuration
     """
 
+    def __init__(self, jobs=None, jobs_per_host=None, scheduler=None):
+        super().__init__()
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+        self.scheduler = scheduler
+
     def __str__(self):
         return 'repos_fetch'
 
     def execute(self, config):
-        repos_fetch(config, config.get_repos())
+        repos_fetch(config, config.get_repos(), self.jobs, self.jobs_per_host,
+                    self.scheduler)
 
 
 class ReposCheckout(Command):
@@ -207,9 +390,84 @@ class ReposCheckout(Command):
         Ensures that the right revision of each repo is check out.
     """
 
+    def __init__(self, jobs=None):
+        super().__init__()
+        self.jobs = jobs
+
     def __str__(self):
         return 'repos_checkout'
 
     def execute(self, config):
-        for repo in config.get_repos():
-            repo_checkout(config, repo)
+        repos_checkout(config, config.get_repos(), self.jobs)
+
+
+class ReposFetchCheckout(Command):
+    """
+        Fetches repositories defined in the configuration and checks out
+        each one as soon as its fetch is done.
+    """
+
+    def __init__(self, jobs=None, jobs_per_host=None, scheduler=None):
+        super().__init__()
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+        self.scheduler = scheduler
+
+    def __str__(self):
+        return 'repos_fetch_checkout'
+
+    def execute(self, config):
+        repos_fetch_checkout(config, config.get_repos(),
+                             self.jobs, self.jobs_per_host, self.scheduler)
+
+
+class ReposSnapshotRestore(Command):
+    """
+        Restores missing repositories from the snapshot directory.
+    """
+
+    def __init__(self, jobs=None, scheduler=None):
+        super().__init__()
+        self.jobs = jobs
+        self.scheduler = scheduler
+
+    def __str__(self):
+        return 'repos_snapshot_restore'
+
+    def execute(self, config):
+        snapshots_restore(config, config.get_repos(), self.jobs,
+                          self.scheduler)
+
+
+class ReposSnapshotStore(Command):
+    """
+        Stores snapshots of the checked out repositories in the snapshot
+        directory.
+    """
+
+    def __init__(self, jobs=None):
+        super().__init__()
+        self.jobs = jobs
+
+    def __str__(self):
+        return 'repos_snapshot_store'
+
+    def execute(self, config):
+        snapshots_store(config, config.get_repos(), self.jobs)
+
+
+def add_repos_commands(macro, args, scheduler=None):
+    """
+        Adds the commands that restore, fetch, check out and store the
+        repositories to the macro, using the job limits of the command line
+        arguments. Fetch and checkout run as one step, unless one of them
+        is skipped.
+    """
+    macro.add(ReposSnapshotRestore(args.jobs, scheduler))
+    if 'repos_fetch' in args.skip or 'repos_checkout' in args.skip:
+        macro.add(ReposFetch(args.jobs, args.jobs_per_host, scheduler))
+        macro.add(ReposCheckout(args.jobs))
+    else:
+        macro.add(ReposFetchCheckout(args.jobs, args.jobs_per_host,
+                                     scheduler))
+    macro.add(ReposSnapshotStore(args.jobs))
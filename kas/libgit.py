@@ -0,0 +1,892 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module contains the git operations on the repositories of kas:
+    cloning, also from mirrors and as shallow or partial clones, fetching,
+    resolving refspecs and checking out, optionally sparse.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import logging
+import asyncio
+from .libkas import (run_cmd_async, is_commit_id, _ensure_future,
+                     FETCH_JOBS, FETCH_JOBS_PER_HOST)
+from .repostate import get_repo_state
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+def _fetch_refspec(refspec, prefix):
+    """
+        Returns the refspec for 'git fetch' that requests only the given
+        commit id or branch from the remote. Fetched branches are stored
+        below the prefix.
+    """
+    if is_commit_id(refspec):
+        return refspec
+    if refspec.startswith('refs/'):
+        return '+{0}:{0}'.format(refspec)
+    return '+refs/heads/{0}:{1}{0}'.format(refspec, prefix)
+
+
+@asyncio.coroutine
+def _repo_contains_async(config, path, refspec):
+    """
+        Returns True if the refspec resolves in the repository.
+    """
+    if get_repo_state(path).rev_parse(refspec):
+        return True
+    (retc, _) = yield from run_cmd_async(['git', 'cat-file', '-e',
+                                          refspec + '^{commit}'],
+                                         env=config.environ,
+                                         cwd=path,
+                                         fail=False,
+                                         liveupdate=False)
+    return retc == 0
+
+
+@asyncio.coroutine
+def _lock_file_async(filename):
+    """
+        Acquires an exclusive lock on the file without blocking the event
+        loop. The lock is released by closing the returned file object.
+    """
+    fds = open(filename, 'w')
+    while True:
+        try:
+            fcntl.flock(fds, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fds
+        except BlockingIOError:
+            yield from asyncio.sleep(0.2)
+
+
+def _read_only_mirror(mirror, err):
+    """
+        Returns the existing mirror for read-only use after the reference
+        directory turned out not to be writable, or None if there is no
+        mirror.
+    """
+    if os.path.isdir(mirror):
+        logging.warning('Cannot update mirror %s, using it read-only: %s',
+                        mirror, err)
+        return mirror
+    logging.warning('Cannot create mirror %s, cloning without it: %s',
+                    mirror, err)
+    return None
+
+
+@asyncio.coroutine
+def _repo_mirror_update_async(config, repo, mirror):
+    """
+        Fetches the refspec of the repository into its existing mirror, or
+        all refs if that does not work.
+    """
+    if is_commit_id(repo.refspec):
+        found = yield from _repo_contains_async(config, mirror, repo.refspec)
+        if found:
+            return
+
+    retc = 1
+    if repo.refspec:
+        (retc, _) = yield from run_cmd_async(
+            ['git', 'fetch', '-q', '--no-tags', 'origin',
+             _fetch_refspec(repo.refspec, 'refs/heads/')],
+            env=config.environ,
+            cwd=mirror,
+            fail=False)
+    if retc:
+        (retc, output) = yield from run_cmd_async(
+            ['git', 'fetch', '-q', '--prune', 'origin'],
+            env=config.environ,
+            cwd=mirror,
+            fail=False)
+    if retc:
+        logging.warning('Could not update mirror %s: %s', mirror, output)
+    else:
+        logging.info('Mirror %s updated', mirror)
+
+
+@asyncio.coroutine
+def _repo_mirror_create_async(config, repo, mirror):
+    """
+        Creates the mirror of the repository and returns its path, or None
+        if the repository could not be cloned.
+    """
+    # Clone into a temporary directory first, so that an interrupted
+    # clone does not leave a broken mirror behind. Automatic garbage
+    # collection is disabled, since checkouts borrow objects from it.
+    tmpdir = mirror + '.tmp'
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    (retc, _) = yield from run_cmd_async(['git', 'clone', '-q',
+                                          '--mirror', '-c', 'gc.auto=0',
+                                          repo.url, tmpdir],
+                                         env=config.environ,
+                                         cwd=os.path.dirname(mirror),
+                                         fail=False)
+    if retc:
+        logging.warning('Could not create mirror of %s in %s',
+                        repo.url, os.path.dirname(mirror))
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return None
+    os.rename(tmpdir, mirror)
+    logging.info('Mirror %s created', mirror)
+    return mirror
+
+
+@asyncio.coroutine
+def _repo_mirror_async(config, repo):
+    """
+        Creates or updates the bare mirror of the repository in the
+        repository reference directory and returns its path. Returns None if
+        no reference directory is configured or the mirror is not usable.
+        An existing mirror is only updated with the refspec of the
+        repository, unless that cannot be fetched on its own. If the
+        reference directory is not writable, an existing mirror is used
+        without updating it.
+    """
+    refdir = config.get_repo_ref_dir()
+    if not refdir:
+        return None
+
+    # git runs in the checkouts, so relative paths would not work there
+    mirror = os.path.join(os.path.abspath(refdir), repo.qualified_name)
+    try:
+        os.makedirs(refdir, exist_ok=True)
+        # The mirror may be shared between several kas instances
+        lock = yield from _lock_file_async(mirror + '.lock')
+    except OSError as err:
+        return _read_only_mirror(mirror, err)
+
+    try:
+        if os.path.exists(mirror):
+            yield from _repo_mirror_update_async(config, repo, mirror)
+            return mirror
+        return (yield from _repo_mirror_create_async(config, repo, mirror))
+    except OSError as err:
+        return _read_only_mirror(mirror, err)
+    finally:
+        lock.close()
+
+
+@asyncio.coroutine
+def _repo_mirror_clone_async(config, repo, mirror):
+    """
+        Creates the checkout of the repository from its mirror, either as
+        worktree of the mirror or as clone that borrows its objects. A
+        mirror that cannot be written to is only borrowed from.
+    """
+    lock = None
+    if config.get_repo_ref_worktree() and \
+       not config.get_repo_ref_dissociate():
+        try:
+            lock = yield from _lock_file_async(mirror + '.lock')
+        except OSError as err:
+            logging.warning('Cannot add worktree to mirror %s, cloning '
+                            'from it instead: %s', mirror, err)
+    if lock:
+        try:
+            # Forget worktrees of checkouts that were removed meanwhile
+            yield from run_cmd_async(['git', 'worktree', 'prune'],
+                                     env=config.environ,
+                                     cwd=mirror,
+                                     fail=False)
+            cmd = ['git', 'worktree', 'add', '-q', '--detach', repo.path]
+            if repo.refspec:
+                cmd.append(repo.refspec)
+            (retc, _) = yield from run_cmd_async(cmd,
+                                                 env=config.environ,
+                                                 cwd=mirror)
+        finally:
+            lock.close()
+        return retc
+
+    cmd = ['git', 'clone', '-q', '--reference', mirror]
+    if config.get_repo_ref_dissociate():
+        cmd.append('--dissociate')
+    cmd.extend([mirror, repo.path])
+    (retc, _) = yield from run_cmd_async(cmd,
+                                         env=config.environ,
+                                         cwd=config.kas_work_dir)
+    if retc == 0:
+        (retc, _) = yield from run_cmd_async(['git', 'remote', 'set-url',
+                                              'origin', repo.url],
+                                             env=config.environ,
+                                             cwd=repo.path)
+    return retc
+
+
+@asyncio.coroutine
+def _repo_clone_async(config, repo):
+    """
+        Clones the repository with its full history.
+    """
+    (retc, _) = yield from run_cmd_async(['git', 'clone', '-q',
+                                          repo.url, repo.path],
+                                         env=config.environ,
+                                         cwd=config.kas_work_dir)
+    return retc
+
+
+@asyncio.coroutine
+def _repo_partial_clone_async(config, repo):
+    """
+        Clones the repository using its shallow or partial clone strategy
+        and checks out its refspec. Falls back to a full clone if the
+        strategy cannot be applied.
+    """
+    if repo.clone == 'shallow':
+        if not is_commit_id(repo.refspec):
+            logging.info('Refspec %s of repository %s is not a commit id, '
+                         'cloning full history', repo.refspec, repo.name)
+            return (yield from _repo_clone_async(config, repo))
+        cmds = [['git', 'init', '-q', repo.path],
+                ['git', 'remote', 'add', 'origin', repo.url],
+                ['git', 'fetch', '-q', '--depth', '1', 'origin',
+                 repo.refspec],
+                ['git', 'checkout', '-q', repo.refspec]]
+    else:
+        clone_filter = 'blob:none' if repo.clone == 'blobless' else 'tree:0'
+        cmds = [['git', 'clone', '-q', '--filter=' + clone_filter,
+                 '--no-checkout', repo.url, repo.path],
+                ['git', 'checkout', '-q', repo.refspec or 'HEAD']]
+
+    for cmd in cmds:
+        if cmd[1] == 'checkout' and repo.sparse:
+            # Limit the checkout before it fetches any file contents
+            yield from _repo_sparse_async(config, repo)
+        cwd = repo.path if os.path.exists(repo.path) else config.kas_work_dir
+        (retc, _) = yield from run_cmd_async(cmd,
+                                             env=config.environ,
+                                             cwd=cwd,
+                                             fail=False)
+        if retc:
+            logging.warning('%s clone of repository %s failed, falling '
+                            'back to a full clone', repo.clone, repo.name)
+            shutil.rmtree(repo.path, ignore_errors=True)
+            return (yield from _repo_clone_async(config, repo))
+    return 0
+
+
+def _sparse_stamp(path):
+    state = get_repo_state(path)
+    if not state.git_dir:
+        return None
+    return os.path.join(state.git_dir, 'kas-sparse-checkout')
+
+
+def repo_sparse_dirs(repo):
+    """
+        Returns the directories the existing checkout of the repository is
+        currently restricted to, or None if it is not a sparse checkout.
+    """
+    stamp = _sparse_stamp(repo.path)
+    try:
+        with open(stamp) as fds:
+            return fds.read().splitlines()
+    except (IOError, OSError, TypeError):
+        return None
+
+
+@asyncio.coroutine
+def _repo_sparse_async(config, repo):
+    """
+        Restricts the working tree of the repository to its sparse
+        directories, or restores the full working tree if it is no longer
+        sparse. Returns 0 on success.
+    """
+    stamp = _sparse_stamp(repo.path)
+    if not stamp:
+        return 0
+    current = repo_sparse_dirs(repo)
+    if current == repo.sparse:
+        return 0
+
+    if repo.sparse is None:
+        cmds = [['git', 'sparse-checkout', 'disable']]
+    else:
+        cmds = [['git', 'sparse-checkout', 'init', '--cone'],
+                ['git', 'sparse-checkout', 'set'] + repo.sparse]
+    for cmd in cmds:
+        (retc, _) = yield from run_cmd_async(cmd,
+                                             env=config.environ,
+                                             cwd=repo.path,
+                                             fail=False)
+        if retc:
+            logging.warning('Could not update sparse checkout of '
+                            'repository %s', repo.name)
+            return retc
+
+    if repo.sparse is None:
+        os.remove(stamp)
+    else:
+        with open(stamp, 'w') as fds:
+            fds.write(''.join(d + '\n' for d in repo.sparse))
+    return 0
+
+
+@asyncio.coroutine
+def _repo_deepen_async(config, repo):
+    """
+        Makes the refspec available in a shallow repository, either by
+        fetching just the missing commit or by fetching the complete history.
+        Returns True if the refspec was fetched.
+    """
+    if is_commit_id(repo.refspec):
+        (retc, _) = yield from run_cmd_async(['git', 'fetch', '-q',
+                                              '--depth', '1', 'origin',
+                                              repo.refspec],
+                                             env=config.environ,
+                                             cwd=repo.path,
+                                             fail=False)
+        if retc == 0:
+            return True
+
+    logging.info('Fetching complete history of repository %s', repo.name)
+    yield from run_cmd_async(['git', 'fetch', '-q', '--unshallow', 'origin'],
+                             env=config.environ,
+                             cwd=repo.path,
+                             fail=False)
+    return False
+
+
+@asyncio.coroutine
+def _repo_create_async(config, repo):
+    """
+        Clones the missing repository, from its mirror if there is one and
+        otherwise using its clone strategy.
+    """
+    os.makedirs(os.path.dirname(repo.path), exist_ok=True)
+    mirror = yield from _repo_mirror_async(config, repo)
+
+    if mirror:
+        if repo.clone != 'full':
+            logging.debug('Ignoring %s clone strategy of repository %s, '
+                          'cloning from mirror', repo.clone, repo.name)
+        retc = yield from _repo_mirror_clone_async(config, repo, mirror)
+    elif repo.clone != 'full':
+        retc = yield from _repo_partial_clone_async(config, repo)
+    else:
+        retc = yield from _repo_clone_async(config, repo)
+    if retc == 0:
+        logging.info('Repository %s cloned', repo.name)
+    return retc
+
+
+@asyncio.coroutine
+def _repo_has_refspec_async(config, repo, state):
+    """
+        Returns True if the existing repository already contains its
+        refspec.
+    """
+    if _checkout_stamp_valid(repo):
+        logging.info('Repository %s is unchanged since its last checkout',
+                     repo.name)
+        return True
+
+    if state.rev_parse(repo.refspec):
+        logging.info('Repository %s already contains %s',
+                     repo.name, repo.refspec)
+        return True
+    (retc, output) = yield from run_cmd_async(['git',
+                                               'cat-file', '-t',
+                                               repo.refspec],
+                                              env=config.environ,
+                                              cwd=repo.path,
+                                              fail=False,
+                                              liveupdate=False)
+    if retc == 0:
+        logging.info('Repository %s already contains %s as %s',
+                     repo.name, repo.refspec, output.strip())
+        return True
+    return False
+
+
+@asyncio.coroutine
+def _repo_fetch_refspec_async(config, repo, mirror):
+    """
+        Fetches only the refspec of the repository from the mirror or the
+        remote, and all refs if that does not work.
+    """
+    refspec = _fetch_refspec(repo.refspec, 'refs/remotes/origin/')
+    (retc, _) = yield from run_cmd_async(['git', 'fetch', '-q', '--no-tags',
+                                          mirror or 'origin', refspec],
+                                         env=config.environ,
+                                         cwd=repo.path,
+                                         fail=False)
+    if retc == 0:
+        found = yield from _repo_contains_async(config, repo.path,
+                                                refspec.split(':')[-1])
+        if found:
+            logging.info('Repository %s updated', repo.name)
+            return
+
+    logging.debug('Could not fetch %s alone, fetching all refs of '
+                  'repository %s', repo.refspec, repo.name)
+    if mirror:
+        cmd = ['git', 'fetch', '-q', '--tags', mirror,
+               '+refs/heads/*:refs/remotes/origin/*']
+    else:
+        cmd = ['git', 'fetch', '--all']
+    (retc, output) = yield from run_cmd_async(cmd,
+                                              env=config.environ,
+                                              cwd=repo.path,
+                                              fail=False)
+    if retc:
+        logging.warning('Could not update repository %s: %s',
+                        repo.name, output)
+    else:
+        logging.info('Repository %s updated', repo.name)
+
+
+@asyncio.coroutine
+def _repo_update_async(config, repo):
+    """
+        Fetches the refspec of the existing repository, unless it already
+        contains it. A failed update is only reported, so it returns 0.
+    """
+    if not repo.refspec:
+        # Without a refspec, the checkout is left as it was cloned
+        return 0
+
+    state = get_repo_state(repo.path)
+    found = yield from _repo_has_refspec_async(config, repo, state)
+    if found:
+        return 0
+
+    # No it is missing, try to fetch
+    if state.git_dir and \
+       os.path.exists(os.path.join(state.common_dir, 'shallow')):
+        fetched = yield from _repo_deepen_async(config, repo)
+        if fetched:
+            logging.info('Repository %s updated', repo.name)
+            return 0
+
+    mirror = yield from _repo_mirror_async(config, repo)
+    if mirror and os.path.realpath(state.common_dir) == \
+            os.path.realpath(mirror):
+        # A worktree of the mirror shares its refs and objects
+        found = yield from _repo_contains_async(config, repo.path,
+                                                repo.refspec)
+        if found:
+            logging.info('Repository %s updated', repo.name)
+        else:
+            logging.warning('Could not update repository %s', repo.name)
+        return 0
+
+    yield from _repo_fetch_refspec_async(config, repo, mirror)
+    return 0
+
+
+@asyncio.coroutine
+def _repo_fetch_async(config, repo):
+    """
+        Start asynchronous repository fetch.
+    """
+    if repo.git_operation_disabled:
+        return 0
+
+    if not os.path.exists(repo.path):
+        return (yield from _repo_create_async(config, repo))
+    return (yield from _repo_update_async(config, repo))
+
+
+class FetchScheduler:
+    """
+        Limits the number of concurrently running repository fetches.
+
+        A global limit caps the total number of running fetches, a per host
+        limit caps the number of fetches against the same remote host. Fetches
+        first queue for a slot of their host and only then for a global slot,
+        so that repositories of a slow or overloaded host do not occupy the
+        global slots needed by the repositories of other hosts.
+
+        The scheduler also keeps the fetch task started for each repository
+        path, so a fetch started while the configuration is loaded is taken
+        over by the steps that fetch all repositories later.
+    """
+
+    def __init__(self, jobs=None, jobs_per_host=None):
+        self.jobs = jobs or FETCH_JOBS
+        self.jobs_per_host = min(jobs_per_host or FETCH_JOBS_PER_HOST,
+                                 self.jobs)
+        self._slots = asyncio.Semaphore(self.jobs)
+        self._host_slots = {}
+        self._fetches = {}
+
+    @asyncio.coroutine
+    def run(self, repo, coro_func, *args):
+        """
+            Runs the coroutine function as soon as a slot for the host of
+            the repository is available and returns its result.
+        """
+        if repo.host not in self._host_slots:
+            self._host_slots[repo.host] = \
+                asyncio.Semaphore(self.jobs_per_host)
+        host_slots = self._host_slots[repo.host]
+
+        queued = time.monotonic()
+        with (yield from host_slots):
+            with (yield from self._slots):
+                started = time.monotonic()
+                ret = yield from coro_func(*args)
+        finished = time.monotonic()
+
+        logging.info('Repository %s: %.1fs queued, %.1fs running',
+                     repo.name, started - queued, finished - started)
+        return ret
+
+    def fetch(self, repo, coro_func, *args):
+        """
+            Starts the coroutine function that fetches the repository
+            through run and returns its task. If a task for the same url
+            and refspec in the path of the repository was started before,
+            that task is returned instead. A task for other settings in the
+            same path only starts once the previous one finished.
+        """
+        (settings, task) = self._fetches.get(repo.path, (None, None))
+        if settings == (repo.url, repo.refspec):
+            return task
+        task = _ensure_future(self._run_after(task, repo, coro_func, *args))
+        self._fetches[repo.path] = ((repo.url, repo.refspec), task)
+        return task
+
+    def started(self, repo):
+        """
+            Returns True if a fetch of the repository with its current url
+            and refspec was started.
+        """
+        (settings, _) = self._fetches.get(repo.path, (None, None))
+        return settings == (repo.url, repo.refspec)
+
+    @asyncio.coroutine
+    def _run_after(self, previous, repo, coro_func, *args):
+        if previous:
+            yield from asyncio.wait([previous])
+        return (yield from self.run(repo, coro_func, *args))
+
+
+def repos_fetch(config, repos, jobs=None, jobs_per_host=None,
+                scheduler=None):
+    """
+        Fetches the list of repositories to the kas_work_dir. Fetches that
+        were already started through the scheduler are waited for instead.
+    """
+    scheduler = scheduler or FetchScheduler(jobs, jobs_per_host)
+    tasks = []
+    for repo in repos:
+        tasks.append(scheduler.fetch(repo, _repo_fetch_async, config, repo))
+
+    if not tasks:
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.wait(tasks))
+
+    for task in tasks:
+        if task.result():
+            sys.exit(task.result())
+
+
+@asyncio.coroutine
+def _repo_resolve_async(config, repo):
+    """
+        Asks the remote for the commit id the refspec of the repository
+        points to. Refspecs the remote does not know, like abbreviated
+        commit ids, are resolved in the existing checkout. Returns None if
+        it cannot be resolved.
+    """
+    if is_commit_id(repo.refspec):
+        return repo.refspec
+
+    (retc, output) = yield from run_cmd_async(['git', 'ls-remote', repo.url,
+                                               repo.refspec,
+                                               repo.refspec + '^{}'],
+                                              env=config.environ,
+                                              cwd=config.kas_work_dir,
+                                              fail=False,
+                                              liveupdate=False)
+    if retc:
+        return None
+
+    refs = {}
+    for line in output.splitlines():
+        (sha, _, name) = line.partition('\t')
+        refs[name.strip()] = sha
+    # Like git rev-parse, prefer tags over branches, and use the commit an
+    # annotated tag points to
+    for name in ['{}', 'refs/tags/{}^{{}}', 'refs/tags/{}', 'refs/heads/{}']:
+        sha = refs.get(name.format(repo.refspec))
+        if sha:
+            return sha
+
+    if not os.path.exists(repo.path):
+        return None
+    (retc, output) = yield from run_cmd_async(['git', 'rev-parse', '--verify',
+                                               '-q',
+                                               repo.refspec + '^{commit}'],
+                                              env=config.environ,
+                                              cwd=repo.path,
+                                              fail=False,
+                                              liveupdate=False)
+    if retc:
+        return None
+    return output.strip()
+
+
+def repos_resolve(config, repo_dict, jobs=None, jobs_per_host=None):
+    """
+        Resolves the refspecs of all repositories in the dictionary to
+        commit ids by asking their remotes in parallel. Returns a dictionary
+        with the same keys and the commit ids as values. Repositories whose
+        refspec cannot be resolved are left out, so they are not pinned.
+    """
+    scheduler = FetchScheduler(jobs, jobs_per_host)
+    tasks = {}
+    for (name, repo) in repo_dict.items():
+        # Without a refspec, the checkout is not moved, so nothing is pinned
+        if repo.git_operation_disabled or not repo.refspec:
+            continue
+        tasks[name] = _ensure_future(
+            scheduler.run(repo, _repo_resolve_async, config, repo))
+
+    if not tasks:
+        return {}
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.wait(list(tasks.values())))
+
+    commits = {name: task.result() for (name, task) in tasks.items()}
+    unresolved = sorted(name for (name, commit) in commits.items()
+                        if not commit)
+    if unresolved:
+        logging.warning('Could not resolve the refspec of repositories, '
+                        'they are not pinned: %s', ', '.join(unresolved))
+    return {name: commit for (name, commit) in commits.items() if commit}
+
+
+def _checkout_stamp(repo):
+    """
+        Returns the file name of the checkout stamp of the repository and
+        the stamp that describes its current checkout, or (None, None).
+    """
+    state = get_repo_state(repo.path)
+    if not state.git_dir:
+        return (None, None)
+    head = state.head()
+    try:
+        index = os.stat(os.path.join(state.git_dir, 'index'))
+    except OSError:
+        return (None, None)
+    if not head:
+        return (None, None)
+    return (os.path.join(state.git_dir, 'kas-checkout'),
+            {'refspec': repo.refspec, 'head': head,
+             'index': [index.st_mtime_ns, index.st_size]})
+
+
+def _checkout_stamp_valid(repo):
+    """
+        Returns True if the repository is still on the commit and index it
+        had after it was last checked out with the same refspec, without
+        running git.
+    """
+    (filename, stamp) = _checkout_stamp(repo)
+    if not filename:
+        return False
+    try:
+        with open(filename) as fds:
+            return json.load(fds) == stamp
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def _write_checkout_stamp(repo):
+    (filename, stamp) = _checkout_stamp(repo)
+    if filename:
+        with open(filename, 'w') as fds:
+            json.dump(stamp, fds)
+
+
+@asyncio.coroutine
+def _repo_checkout_async(config, repo):
+    """
+        Checks out the correct revision of the repo. Returns 0 on success.
+    """
+    if repo.git_operation_disabled:
+        return 0
+
+    retc = yield from _repo_sparse_async(config, repo)
+    if retc or not repo.refspec:
+        return retc
+
+    if _checkout_stamp_valid(repo):
+        logging.info('Repo %s is unchanged since its last checkout. '
+                     'nothing to do', repo.name)
+        return 0
+
+    # Check if current HEAD is what in the config file is defined.
+    state = get_repo_state(repo.path)
+    head = state.head()
+    if head is None:
+        (retc, output) = yield from run_cmd_async(['git', 'rev-parse',
+                                                   '--verify', 'HEAD'],
+                                                  env=config.environ,
+                                                  cwd=repo.path)
+        if retc:
+            return retc
+        head = output.strip()
+
+    # Worktrees share their branches with the mirror and other worktrees,
+    # so they always use a detached HEAD.
+    worktree = state.git_dir != state.common_dir
+    if head == repo.refspec or \
+       state.head_ref() == 'refs/heads/{}'.format(repo.refspec) or \
+       (worktree and head == state.rev_parse(repo.refspec)):
+        logging.info('Repo %s has already checkout out correct '
+                     'refspec. nothing to do', repo.name)
+        _write_checkout_stamp(repo)
+        return 0
+
+    return (yield from _repo_switch_async(config, repo, worktree))
+
+
+@asyncio.coroutine
+def _repo_switch_async(config, repo, worktree):
+    """
+        Checks out the refspec of the repository, unless its working tree
+        is dirty. Worktrees use a detached HEAD. Returns 0 on success.
+    """
+    # Check if repos is dirty
+    (retc, _) = yield from run_cmd_async(['git', 'diff', '--quiet'],
+                                         env=config.environ,
+                                         cwd=repo.path,
+                                         fail=False)
+    if retc:
+        logging.warning('Repo %s is dirty. no checkout', repo.name)
+        return 0
+
+    cmd = ['git', 'checkout', '-q']
+    if worktree:
+        cmd.append('--detach')
+    cmd.append('{refspec}'.format(refspec=repo.refspec))
+    (retc, _) = yield from run_cmd_async(cmd,
+                                         env=config.environ,
+                                         cwd=repo.path)
+    if retc == 0:
+        _write_checkout_stamp(repo)
+    return retc
+
+
+def repos_checkout(config, repos, jobs=None):
+    """
+        Checks out the correct revision of all repos, running up to jobs
+        checkouts concurrently. Exits if any checkout failed.
+    """
+    slots = asyncio.Semaphore(jobs or FETCH_JOBS)
+
+    @asyncio.coroutine
+    def _checkout(repo):
+        with (yield from slots):
+            return (yield from _repo_checkout_async(config, repo))
+
+    tasks = [_ensure_future(_checkout(repo)) for repo in repos]
+    if not tasks:
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.wait(tasks))
+
+    failed = [(repo, task.result())
+              for (repo, task) in zip(repos, tasks) if task.result()]
+    if failed:
+        logging.error('Checkout failed for repositories: %s',
+                      ', '.join(repo.name for (repo, _) in failed))
+        sys.exit(failed[0][1])
+
+
+@asyncio.coroutine
+def repo_fetch_checkout_async(config, repo, scheduler, slots):
+    """
+        Fetches the repository through the scheduler and checks it out
+        while holding one of the checkout slots. Returns the name of the
+        last step and its return code.
+    """
+    retc = yield from scheduler.fetch(repo, _repo_fetch_async, config, repo)
+    if retc:
+        return ('Fetch', retc)
+    with (yield from slots):
+        retc = yield from _repo_checkout_async(config, repo)
+    return ('Checkout', retc)
+
+
+def exit_on_fetch_checkout_failure(repos, tasks):
+    """
+        Reports the repositories whose repo_fetch_checkout_async task failed
+        and exits with the return code of the first failure.
+    """
+    failed = [(repo,) + task.result()
+              for (repo, task) in zip(repos, tasks) if task.result()[1]]
+    for step in ('Fetch', 'Checkout'):
+        names = [repo.name for (repo, failed_step, _) in failed
+                 if failed_step == step]
+        if names:
+            logging.error('%s failed for repositories: %s',
+                          step, ', '.join(names))
+    if failed:
+        sys.exit(failed[0][2])
+
+
+def repos_fetch_checkout(config, repos, jobs=None, jobs_per_host=None,
+                         scheduler=None):
+    """
+        Fetches and checks out the repositories. Every repository is checked
+        out as soon as its own fetch is done, without waiting for the fetches
+        of the other repositories. Fetches that were already started through
+        the scheduler are taken over. Exits if any fetch or checkout failed.
+    """
+    scheduler = scheduler or FetchScheduler(jobs, jobs_per_host)
+    slots = asyncio.Semaphore(scheduler.jobs)
+
+    tasks = [_ensure_future(repo_fetch_checkout_async(config, repo,
+                                                      scheduler, slots))
+             for repo in repos]
+    if not tasks:
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.wait(tasks))
+
+    exit_on_fetch_checkout_failure(repos, tasks)
+
+
+def repo_checkout(config, repo):
+    """
+        Checks out the correct revision of the repo.
+    """
+    repos_checkout(config, [repo])
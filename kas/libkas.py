@@ -25,15 +25,23 @@
 
 import re
 import os
+import json
 import sys
+import hashlib
 import logging
 import tempfile
+import argparse
 import asyncio
 from subprocess import Popen, PIPE
+from .repostate import get_repo_state
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
+# Default limits for concurrently running repository fetches
+FETCH_JOBS = 8
+FETCH_JOBS_PER_HOST = 4
+
 
 class LogOutput:
     """
@@ -153,111 +161,110 @@ def find_program(paths, name):
     return None
 
 
-@asyncio.coroutine
-def _repo_fetch_async(config, repo):
-    """
-        Start asynchronous repository fetch.
-    """
-    if repo.git_operation_disabled:
-        return 0
-
-    if not os.path.exists(repo.path):
-        os.makedirs(os.path.dirname(repo.path), exist_ok=True)
-        gitsrcdir = os.path.join(config.get_repo_ref_dir() or '',
-                                 repo.qualified_name)
-        logging.debug('Looking for repo ref dir in %s', gitsrcdir)
-
-        cmd = ['git', 'clone', '-q', repo.url, repo.path]
-        if config.get_repo_ref_dir() and os.path.exists(gitsrcdir):
-            cmd.extend(['--reference', gitsrcdir])
-        (retc, _) = yield from run_cmd_async(cmd,
-                                             env=config.environ,
-                                             cwd=config.kas_work_dir)
-        if retc == 0:
-            logging.info('Repository %s cloned', repo.name)
-        return retc
-
-    # Does refspec exist in the current repository?
-    (retc, output) = yield from run_cmd_async(['git',
-                                               'cat-file', '-t',
-                                               repo.refspec],
-                                              env=config.environ,
-                                              cwd=repo.path,
-                                              fail=False,
-                                              liveupdate=False)
-    if retc == 0:
-        logging.info('Repository %s already contains %s as %s',
-                     repo.name, repo.refspec, output.strip())
-        return retc
-
-    # No it is missing, try to fetch
-    (retc, output) = yield from run_cmd_async(['git',
-                                               'fetch', '--all'],
-                                              env=config.environ,
-                                              cwd=repo.path,
-                                              fail=False)
-    if retc:
-        logging.warning('Could not update repository %s: %s',
-                        repo.name, output)
-    else:
-        logging.info('Repository %s updated', repo.name)
-    return 0
-
-
-def repos_fetch(config, repos):
+def positive_int(value):
     """
-        Fetches the list of repositories to the kas_work_dir.
+        Converts a command line argument to an integer greater than zero.
     """
-    tasks = []
-    for repo in repos:
-        if not hasattr(asyncio, 'ensure_future'):
-            # pylint: disable=no-member,deprecated-method
-            task = asyncio.async(_repo_fetch_async(config, repo))
-        else:
-            task = asyncio.ensure_future(_repo_fetch_async(config, repo))
-        tasks.append(task)
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            '{} is not a positive number'.format(value))
+    return number
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait(tasks))
 
-    for task in tasks:
-        if task.result():
-            sys.exit(task.result())
+def add_job_arguments(parser):
+    """
+        Adds the arguments that limit the concurrent repository operations
+        and that keep the bitbake server running to the parser of a plugin.
+    """
+    parser.add_argument('-j', '--jobs',
+                        type=positive_int,
+                        help='Maximum number of repositories fetched or '
+                        'checked out in parallel (default: {})'
+                        .format(FETCH_JOBS))
+    parser.add_argument('--jobs-per-host',
+                        type=positive_int,
+                        help='Maximum number of repositories fetched '
+                        'in parallel from the same host (default: {})'
+                        .format(FETCH_JOBS_PER_HOST))
+    parser.add_argument('--bb-server-timeout',
+                        type=int,
+                        help='Keep the bitbake server in memory for this '
+                        'many seconds after bitbake exits (-1 for no '
+                        'timeout), so later calls reuse it. Overrides '
+                        'BB_SERVER_TIMEOUT')
+
+
+def is_commit_id(refspec):
+    """
+        Returns True if the refspec is a full commit id.
+    """
+    return bool(refspec and re.match(r'^[0-9a-f]{40}$', refspec))
 
 
-def repo_checkout(config, repo):
+def _ensure_future(coro):
     """
-        Checks out the correct revision of the repo.
+        Schedules the execution of the coroutine as a task.
     """
-    if repo.git_operation_disabled:
-        return
+    if not hasattr(asyncio, 'ensure_future'):
+        # pylint: disable=no-member,deprecated-method
+        return asyncio.async(coro)
+    return asyncio.ensure_future(coro)
+
+
+def _build_environ_key(init_repo, init_script, build_dir, inputs):
+    hasher = hashlib.sha256()
+    with open(os.path.join(init_repo.path, init_script), 'rb') as fds:
+        hasher.update(fds.read())
+    head = get_repo_state(init_repo.path).head()
+    (_, status) = run_cmd(['git', 'status', '--porcelain'],
+                          cwd=init_repo.path, fail=False, liveupdate=False)
+    hasher.update(json.dumps([head, status, inputs,
+                              os.path.abspath(build_dir)],
+                             sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
 
-    # Check if repos is dirty
-    (_, output) = run_cmd(['git', 'diff', '--shortstat'],
-                          env=config.environ, cwd=repo.path,
-                          fail=False)
-    if output:
-        logging.warning('Repo %s is dirty. no checkout', repo.name)
-        return
 
-    # Check if current HEAD is what in the config file is defined.
-    (_, output) = run_cmd(['git', 'rev-parse',
-                           '--verify', 'HEAD'],
-                          env=config.environ, cwd=repo.path)
+def _build_environ_file(build_dir):
+    return os.path.join(build_dir, '.kas-environ.json')
 
-    if output.strip() == repo.refspec:
-        logging.info('Repo %s has already checkout out correct '
-                     'refspec. nothing to do', repo.name)
-        return
 
-    run_cmd(['git', 'checkout', '-q',
-             '{refspec}'.format(refspec=repo.refspec)],
-            cwd=repo.path)
+def _read_build_environ(build_dir, key):
+    """
+        Returns the build environment stored with the key or None.
+    """
+    # Sourcing the init script also creates the conf directory
+    if not os.path.isdir(os.path.join(build_dir, 'conf')):
+        return None
+    try:
+        with open(_build_environ_file(build_dir)) as fds:
+            stored = json.load(fds)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(stored, dict) or stored.get('key') != key:
+        return None
+    return stored.get('environ')
+
+
+def _write_build_environ(build_dir, key, env):
+    filename = _build_environ_file(build_dir)
+    tmpfile = filename + '.tmp'
+    try:
+        with open(tmpfile, 'w') as fds:
+            json.dump({'key': key, 'environ': env}, fds)
+        os.replace(tmpfile, filename)
+    except (IOError, OSError) as err:
+        logging.debug('Could not store the build environment in %s: %s',
+                      filename, err)
 
 
 def get_build_environ(config, build_dir):
     """
-        Create the build environment variables.
+        Create the build environment variables. The environment the init
+        script creates is stored in the build directory and used again until
+        the init script, the commit or the local changes of its repository,
+        the build directory or the proxy and BB_ENV_EXTRAWHITE settings of
+        the host change.
     """
     # pylint: disable=too-many-locals
     # nasty side effect function: running oe/isar-init-build-env also
@@ -280,31 +287,48 @@ def get_build_environ(config, build_dir):
         logging.error('Did not find any init-build-env script')
         sys.exit(1)
 
-    get_bb_env_file = tempfile.mktemp()
-    with open(get_bb_env_file, 'w') as fds:
-        script = """#!/bin/bash
+    script = """#!/bin/bash
         set -e
         source %s $1 > /dev/null
         env
         """ % init_script
-        fds.write(script)
-    os.chmod(get_bb_env_file, 0o775)
 
     env = {}
     env['PATH'] = '/usr/sbin:/usr/bin:/sbin:/bin'
 
-    (_, output) = run_cmd([get_bb_env_file, build_dir],
-                          cwd=init_repo.path, env=env, liveupdate=False)
+    # The environment depends on what the init script sources, which is
+    # part of the init repo, on the build directory and on the host settings
+    # bitbake and the fetchers pick up
+    host_env = {'BB_ENV_EXTRAWHITE': os.environ.get('BB_ENV_EXTRAWHITE')}
+    host_env.update(config.get_proxy_config())
+    environ_key = _build_environ_key(init_repo, init_script, build_dir,
+                                     [script, env, host_env])
+    cached = None
+    if not config.get_build_environ_refresh():
+        cached = _read_build_environ(build_dir, environ_key)
+    if cached is not None:
+        logging.info('Using the build environment of %s from %s',
+                     init_script, build_dir)
+        env = cached
+    else:
+        get_bb_env_file = tempfile.mktemp()
+        with open(get_bb_env_file, 'w') as fds:
+            fds.write(script)
+        os.chmod(get_bb_env_file, 0o775)
 
-    os.remove(get_bb_env_file)
+        (_, output) = run_cmd([get_bb_env_file, build_dir],
+                              cwd=init_repo.path, env=env, liveupdate=False)
 
-    env = {}
-    for line in output.splitlines():
-        try:
-            (key, val) = line.split('=', 1)
-            env[key] = val
-        except ValueError:
-            pass
+        os.remove(get_bb_env_file)
+
+        env = {}
+        for line in output.splitlines():
+            try:
+                (key, val) = line.split('=', 1)
+                env[key] = val
+            except ValueError:
+                pass
+        _write_build_environ(build_dir, environ_key, env)
 
     conf_env = config.get_environment()
 
@@ -319,7 +343,8 @@ def get_build_environ(config, build_dir):
 
     env_vars.extend(['SSH_AGENT_PID', 'SSH_AUTH_SOCK',
                      'SHELL', 'TERM',
-                     'GIT_PROXY_COMMAND', 'NO_PROXY'])
+                     'GIT_PROXY_COMMAND', 'NO_PROXY',
+                     'BB_SERVER_TIMEOUT'])
 
     for env_var in env_vars:
         if env_var in os.environ:
@@ -30,39 +30,96 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
 
+class _CachedProperty:
+    """
+        A property that is computed on the first access and then stored in
+        the instance, which hides the property from then on.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.func(instance)
+        instance.__dict__[self.func.__name__] = value
+        return value
+
+
 class Repo:
     """
         Represents a repository in the kas configuration.
     """
 
-    def __init__(self, url, path, refspec=None, layers=None):
+    def __init__(self, url, path, refspec=None, layers=None, clone='full',
+                 sparse=None):
+        # pylint: disable=too-many-arguments
         self.url = url
         self.path = path
         self.refspec = refspec
+        self.clone = clone
+        # The directories of a sparse checkout or None
+        self.sparse = sparse
         self._layers = layers
-        self.name = os.path.basename(self.path)
         self.git_operation_disabled = False
 
+    @property
+    def name(self):
+        """
+            The name of the repository, the last component of its path.
+        """
+        return os.path.basename(self.path)
+
+    # The properties below are derived from the settings of the repository,
+    # which do not change, so they are computed only once.
+
+    @_CachedProperty
+    def layers(self):
+        """
+            The paths of the layers of the repository.
+        """
+        if self._layers:
+            return [self.path + '/' + layer for layer in self._layers]
+        return [self.path]
+
+    @_CachedProperty
+    def qualified_name(self):
+        """
+            The name of the repository derived from its url, which is unique
+            across hosts.
+        """
+        url = urlparse(self.url)
+        return ('{url.netloc}{url.path}'
+                .format(url=url)
+                .replace('@', '.')
+                .replace(':', '.')
+                .replace('/', '.')
+                .replace('*', '.'))
+
+    @_CachedProperty
+    def host(self):
+        """
+            The host the repository is fetched from, or an empty string for
+            local repositories.
+        """
+        if '://' in self.url:
+            # file:// urls have no host
+            return urlparse(self.url).hostname or ''
+        # scp-like syntax, e.g. git@github.com:siemens/kas.git
+        (host, sep, _) = self.url.partition(':')
+        if sep and '/' not in host:
+            return host.split('@')[-1]
+        # local path
+        return ''
+
     def disable_git_operations(self):
         """
             Disabled all git operation for this repository.
         """
         self.git_operation_disabled = True
 
-    def __getattr__(self, item):
-        if item == 'layers':
-            if not self._layers:
-                return [self.path]
-            return [self.path + '/' + l for l in self._layers]
-        elif item == 'qualified_name':
-            url = urlparse(self.url)
-            return ('{url.netloc}{url.path}'
-                    .format(url=url)
-                    .replace('@', '.')
-                    .replace(':', '.')
-                    .replace('/', '.')
-                    .replace('*', '.'))
-
     def __str__(self):
         return '%s:%s %s %s' % (self.url, self.refspec,
                                 self.path, self._layers)
@@ -0,0 +1,340 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module reads the state of git repositories directly from the
+    repository files, without starting git processes.
+
+    The lookups only give positive answers they are sure about. If a ref or
+    an object is not found, it might still be available in a way this module
+    does not understand (e.g. promisor remotes or other ref storage formats),
+    so callers should fall back to asking git in that case.
+"""
+
+import os
+import re
+import mmap
+import struct
+import binascii
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+COMMIT_ID = re.compile(r'^[0-9a-f]{40}$')
+
+# The order in which git tries to expand a short ref name
+REF_RULES = ['{}', 'refs/{}', 'refs/tags/{}', 'refs/heads/{}',
+             'refs/remotes/{}', 'refs/remotes/{}/HEAD']
+
+
+def find_toplevel(path):
+    """
+        Returns the top level directory of the git working tree containing
+        the path or None if it is not part of a working tree.
+    """
+    path = os.path.abspath(path)
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _read_file(filename):
+    try:
+        with open(filename) as fds:
+            return fds.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class PackIndex:
+    """
+        The sorted object names of a pack index file. The file is mapped
+        into memory and only the pages a lookup needs are read.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fds:
+            self.data = mmap.mmap(fds.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] == b'\377tOc':
+            (version,) = struct.unpack_from('>I', self.data, 4)
+            if version != 2:
+                raise ValueError('Unsupported pack index version {}'
+                                 .format(version))
+            self.fanout = 8
+            self.start = self.fanout + 256 * 4
+            self.stride = 20
+            self.offset = 0
+        else:
+            self.fanout = 0
+            self.start = 256 * 4
+            self.stride = 24
+            self.offset = 4
+        self.count = self._fanout(255)
+        if len(self.data) < self.start + self.count * self.stride:
+            raise ValueError('Truncated pack index {}'.format(filename))
+
+    def _fanout(self, byte):
+        return struct.unpack_from('>I', self.data, self.fanout + byte * 4)[0]
+
+    def _name(self, index):
+        pos = self.start + index * self.stride + self.offset
+        return self.data[pos:pos + 20]
+
+    def __contains__(self, name):
+        # The fanout table limits the search to the names with the same
+        # first byte
+        first = name[0]
+        (low, high) = (self._fanout(first - 1) if first else 0,
+                       self._fanout(first))
+        while low < high:
+            mid = (low + high) // 2
+            current = self._name(mid)
+            if current == name:
+                return True
+            if current < name:
+                low = mid + 1
+            else:
+                high = mid
+        return False
+
+
+def _signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class RepoState:
+    """
+        Answers questions about the state of a git repository by reading
+        HEAD, the refs, packed-refs and the object store directly.
+
+        What is read from packed-refs and the pack indices is kept, as long
+        as the files do not change, so an instance can be used for the
+        whole run, also while git modifies the repository.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.git_dir = self._find_git_dir(path)
+        self.common_dir = self.git_dir
+        if self.git_dir:
+            commondir = _read_file(os.path.join(self.git_dir, 'commondir'))
+            if commondir:
+                self.common_dir = os.path.normpath(
+                    os.path.join(self.git_dir, commondir))
+        self._packed_refs = (None, {})
+        self._packs = {}
+
+    @staticmethod
+    def _find_git_dir(path):
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return dotgit
+        if os.path.isfile(dotgit):
+            content = _read_file(dotgit) or ''
+            if content.startswith('gitdir:'):
+                return os.path.normpath(
+                    os.path.join(path, content[len('gitdir:'):].strip()))
+            return None
+        # bare repository
+        if os.path.isfile(os.path.join(path, 'HEAD')) and \
+           os.path.isdir(os.path.join(path, 'objects')):
+            return path
+        return None
+
+    def _packed(self):
+        filename = os.path.join(self.common_dir, 'packed-refs')
+        signature = _signature(filename)
+        if signature != self._packed_refs[0]:
+            packed_refs = {}
+            content = _read_file(filename) or ''
+            for line in content.splitlines():
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                (sha, _, name) = line.partition(' ')
+                packed_refs[name] = sha
+            self._packed_refs = (signature, packed_refs)
+        return self._packed_refs[1]
+
+    def read_ref(self, name, depth=5):
+        """
+            Returns the commit id the ref with the full name points to or
+            None.
+        """
+        if not self.git_dir or depth == 0:
+            return None
+        # HEAD and some other refs are stored per working tree
+        for base in (self.git_dir, self.common_dir):
+            content = _read_file(os.path.join(base, name))
+            if content is not None:
+                break
+        else:
+            content = self._packed().get(name)
+        if content is None:
+            return None
+        if content.startswith('ref:'):
+            return self.read_ref(content[len('ref:'):].strip(), depth - 1)
+        return content if COMMIT_ID.match(content) else None
+
+    def head(self):
+        """
+            Returns the commit id HEAD points to or None.
+        """
+        return self.read_ref('HEAD')
+
+    def head_ref(self):
+        """
+            Returns the name of the branch HEAD points to or None if HEAD is
+            detached.
+        """
+        if not self.git_dir:
+            return None
+        content = _read_file(os.path.join(self.git_dir, 'HEAD')) or ''
+        if content.startswith('ref:'):
+            return content[len('ref:'):].strip()
+        return None
+
+    def _objects(self):
+        object_dirs = []
+        pending = [os.path.join(self.common_dir, 'objects')]
+        while pending:
+            objdir = os.path.normpath(pending.pop(0))
+            if objdir in object_dirs or not os.path.isdir(objdir):
+                continue
+            object_dirs.append(objdir)
+            alternates = _read_file(os.path.join(objdir, 'info',
+                                                 'alternates')) or ''
+            for line in alternates.splitlines():
+                if line and not line.startswith('#'):
+                    pending.append(os.path.join(objdir, line))
+        return object_dirs
+
+    def _pack_indices(self, objdir):
+        packdir = os.path.join(objdir, 'pack')
+        try:
+            names = sorted(name for name in os.listdir(packdir)
+                           if name.endswith('.idx'))
+        except OSError:
+            names = []
+        indices = []
+        for name in names:
+            # Pack files are named after their content, so an index that
+            # was read before is still valid
+            filename = os.path.join(packdir, name)
+            if filename not in self._packs:
+                try:
+                    self._packs[filename] = PackIndex(filename)
+                except (IOError, OSError, ValueError, struct.error):
+                    self._packs[filename] = None
+            if self._packs[filename]:
+                indices.append(self._packs[filename])
+        return indices
+
+    def has_objects(self, shas):
+        """
+            Returns the set of the commit ids that are in the local object
+            store of the repository or one of its alternates. The object
+            store is walked only once for all of them.
+        """
+        if not self.git_dir:
+            return set()
+        missing = set(sha for sha in shas if COMMIT_ID.match(sha))
+        found = set()
+        for objdir in self._objects():
+            if not missing:
+                break
+            for sha in list(missing):
+                if os.path.exists(os.path.join(objdir, sha[:2], sha[2:])):
+                    missing.discard(sha)
+                    found.add(sha)
+            for index in self._pack_indices(objdir):
+                for sha in list(missing):
+                    if binascii.unhexlify(sha) in index:
+                        missing.discard(sha)
+                        found.add(sha)
+        return found
+
+    def has_object(self, sha):
+        """
+            Returns True if the object is in the local object store of the
+            repository or one of its alternates.
+        """
+        return bool(self.has_objects([sha]))
+
+    def rev_parse_many(self, refspecs):
+        """
+            Returns a dictionary with the commit id of each refspec, like
+            rev_parse, answering all of them in one pass.
+        """
+        result = {}
+        commits = []
+        for refspec in refspecs:
+            result[refspec] = None
+            if not refspec or not self.git_dir:
+                continue
+            if COMMIT_ID.match(refspec):
+                commits.append(refspec)
+                continue
+            for rule in REF_RULES:
+                sha = self.read_ref(rule.format(refspec))
+                if sha:
+                    result[refspec] = sha
+                    break
+        for sha in self.has_objects(commits):
+            result[sha] = sha
+        return result
+
+    def rev_parse(self, refspec):
+        """
+            Returns the commit id of the refspec, if it is a commit id
+            available in the repository or a ref name, or None.
+        """
+        return self.rev_parse_many([refspec])[refspec]
+
+
+_STATES = {}
+
+
+def get_repo_state(path):
+    """
+        Returns the RepoState of the repository at the path. The same
+        instance is returned during the whole run, unless the repository
+        was replaced, e.g. by a new clone.
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(os.path.join(path, '.git'))
+        # A new clone or worktree creates a new .git
+        signature = (stat.st_dev, stat.st_ino)
+    except OSError:
+        signature = None
+    (known, state) = _STATES.get(path, (None, None))
+    if state is None or known != signature or not state.git_dir:
+        state = RepoState(path)
+        _STATES[path] = (signature, state)
+    return state
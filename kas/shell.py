@@ -24,11 +24,14 @@
     environment
 """
 
+import os
 import subprocess
-from kas.libkas import kasplugin
-from kas.config import Config
+from kas.libkas import kasplugin, add_job_arguments
+from kas.config import create_context
+from kas.libgit import FetchScheduler
 from kas.libcmds import (Macro, Command, SetupDir, SetupProxy, SetupEnviron,
-                         WriteConfig, SetupHome, ReposFetch, ReposCheckout)
+                         WriteConfig, SetupHome, ReposLock, BitbakeServer,
+                         add_repos_commands)
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
@@ -55,6 +58,7 @@ class Shell:
                             action='append',
                             help='Select target to build',
                             default='core-image-minimal')
+        add_job_arguments(sh_prs)
         sh_prs.add_argument('--skip',
                             help='Skip build steps',
                             default=[])
@@ -74,23 +78,33 @@ class Shell:
         if args.cmd != 'shell':
             return False
 
-        cfg = Config(args.config, args.target)
-
-        macro = Macro()
-
+        # Loading already fetches the repositories
+        scheduler = FetchScheduler(args.jobs, args.jobs_per_host)
+        setup = Macro()
         if not args.keep_config_unchanged:
-            macro.add(SetupDir())
+            setup.add(SetupDir())
+        setup.add(SetupProxy())
 
-        macro.add(SetupProxy())
-        macro.add(SetupEnviron())
+        cfg = create_context(
+            args.config, target=args.target,
+            prepare_repos=not args.keep_config_unchanged,
+            prefetch_repos='repos_fetch' not in args.skip,
+            scheduler=scheduler,
+            setup=lambda context: setup.run(context, args.skip))
 
-        if not args.keep_config_unchanged:
-            macro.add(ReposFetch())
-            macro.add(ReposCheckout())
-            macro.add(SetupEnviron())
+        macro = Macro()
+
+        if args.keep_config_unchanged:
+            macro.add(SetupEnviron(args.bb_server_timeout))
+        else:
+            # SetupDir changes into the work directory
+            macro.add(ReposLock(os.path.abspath(args.config)))
+            add_repos_commands(macro, args, scheduler)
+            macro.add(SetupEnviron(args.bb_server_timeout))
             macro.add(WriteConfig())
 
         macro.add(SetupHome())
+        macro.add(BitbakeServer())
         macro.add(ShellCommand(args.command))
 
         macro.run(cfg, args.skip)
@@ -0,0 +1,323 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module stores checkouts of repositories as compressed archives,
+    keyed by the commit they are on, and restores them without running git.
+
+    The archive of a repository is stored as
+    <snapshot dir>/<qualified name>/<commit>.tar.gz together with the sha256
+    of the archive in <commit>.tar.gz.sha256 and the tree of the commit in
+    <commit>.tar.gz.tree. Only clean checkouts of a commit id, that do not
+    borrow objects from another repository, are stored.
+"""
+
+import os
+import shutil
+import asyncio
+import subprocess
+import hashlib
+import logging
+import tarfile
+from .libkas import run_cmd_async, is_commit_id, _ensure_future, FETCH_JOBS
+from .repostate import RepoState, get_repo_state
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+class _HashingFile:
+    """
+        Wraps a file object and computes the sha256 of all data read from or
+        written to it.
+    """
+
+    def __init__(self, fds):
+        self.fds = fds
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        """
+            Reads up to size bytes and adds them to the hash.
+        """
+        data = self.fds.read(size)
+        self.sha256.update(data)
+        return data
+
+    def write(self, data):
+        """
+            Adds the data to the hash and writes it.
+        """
+        self.sha256.update(data)
+        return self.fds.write(data)
+
+    def hexdigest(self):
+        """
+            Returns the sha256 of the data read or written so far.
+        """
+        return self.sha256.hexdigest()
+
+
+def _snapshot_file(snapshot_dir, repo, commit):
+    return os.path.join(snapshot_dir, repo.qualified_name,
+                        commit + '.tar.gz')
+
+
+def _read_checksum(filename, suffix='.sha256'):
+    try:
+        with open(filename + suffix) as fds:
+            return fds.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+def _head_tree(path):
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD^{tree}'],
+                                   cwd=path,
+                                   universal_newlines=True).strip()
+
+
+def _hash_file(filename):
+    hasher = _HashingFile(open(filename, 'rb'))
+    with hasher.fds:
+        while hasher.read(1 << 16):
+            pass
+    return hasher.hexdigest()
+
+
+def _is_inside(name):
+    name = os.path.normpath(name)
+    return not os.path.isabs(name) and name != '..' and \
+        not name.startswith('..' + os.sep)
+
+
+def _through_symlink(name, symlinks):
+    """
+        Returns True if the path passes through one of the symlinks on the
+        way to its last component.
+    """
+    parts = name.split('/')
+    return any(os.path.normpath('/'.join(parts[:i])) in symlinks
+               for i in range(1, len(parts)))
+
+
+def _is_safe(member, symlinks):
+    """
+        Returns True if extracting the archive member only writes below the
+        target directory. The paths of the symlinks in the archive are
+        checked as text only, so no member may pass through them.
+    """
+    if not _is_inside(member.name) or \
+       _through_symlink(member.name, symlinks):
+        return False
+    if member.issym():
+        target = os.path.join(os.path.dirname(member.name), member.linkname)
+        return _is_inside(target) and \
+            not _through_symlink(target, symlinks)
+    if member.islnk():
+        return _is_inside(member.linkname) and \
+            not _through_symlink(member.linkname, symlinks)
+    return member.isfile() or member.isdir()
+
+
+def _is_checkout_of(path, commit, tree):
+    return RepoState(path).head() == commit and _head_tree(path) == tree
+
+
+def _restore(repo, filename):
+    """
+        Extracts the archive to the path of the repository. The archive is
+        only extracted if its checksum matches and all its members stay
+        within the repository. The tree of the extracted checkout has to
+        match the one recorded when storing the archive.
+    """
+    checksum = _read_checksum(filename)
+    tree = _read_checksum(filename, '.tree')
+    if not checksum or not tree:
+        return False
+
+    tmpdir = repo.path + '.snapshot'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    try:
+        if _hash_file(filename) != checksum:
+            logging.warning('Checksum mismatch of snapshot %s', filename)
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(repo.path)),
+                    exist_ok=True)
+        with tarfile.open(filename, mode='r:gz') as tar:
+            members = tar.getmembers()
+            symlinks = set(os.path.normpath(member.name)
+                           for member in members if member.issym())
+            if not all(_is_safe(member, symlinks) for member in members):
+                logging.warning('Snapshot %s contains files outside of the '
+                                'repository', filename)
+                return False
+            tar.extractall(tmpdir, members)
+        if not _is_checkout_of(tmpdir, repo.refspec, tree):
+            logging.warning('Snapshot %s does not contain commit %s',
+                            filename, repo.refspec)
+            return False
+        os.rename(tmpdir, repo.path)
+    except (IOError, OSError, tarfile.TarError,
+            subprocess.CalledProcessError) as err:
+        logging.warning('Could not restore snapshot %s: %s', filename, err)
+        return False
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return True
+
+
+def _store(repo, filename):
+    """
+        Writes the archive of the repository. The archive is written to a
+        temporary file first, so that concurrent readers never see a
+        partial archive.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    suffixes = ('', '.sha256', '.tree')
+    try:
+        with open(tmpfile + '.tree', 'w') as fds:
+            fds.write(_head_tree(repo.path) + '\n')
+        with open(tmpfile, 'wb') as fds:
+            writer = _HashingFile(fds)
+            with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+                tar.add(repo.path, arcname='.')
+        with open(tmpfile + '.sha256', 'w') as fds:
+            fds.write('{}  {}\n'.format(writer.hexdigest(),
+                                        os.path.basename(filename)))
+        for suffix in reversed(suffixes):
+            os.replace(tmpfile + suffix, filename + suffix)
+    finally:
+        for suffix in suffixes:
+            if os.path.exists(tmpfile + suffix):
+                os.remove(tmpfile + suffix)
+
+
+@asyncio.coroutine
+def snapshot_restore_async(config, repo):
+    """
+        Restores the repository from the snapshot directory, if it is
+        missing and a snapshot of its commit is available.
+    """
+    snapshot_dir = config.get_repo_snapshot_dir()
+    if snapshot_dir:
+        yield from _snapshot_restore_async(repo, snapshot_dir)
+
+
+@asyncio.coroutine
+def _snapshot_restore_async(repo, snapshot_dir):
+    if os.path.exists(repo.path) or not is_commit_id(repo.refspec):
+        return
+    filename = _snapshot_file(snapshot_dir, repo, repo.refspec)
+    if not os.path.exists(filename):
+        return
+
+    loop = asyncio.get_event_loop()
+    restored = yield from loop.run_in_executor(None, _restore,
+                                               repo, filename)
+    if restored:
+        logging.info('Repository %s restored from snapshot', repo.name)
+
+
+@asyncio.coroutine
+def _snapshot_store_async(config, repo, snapshot_dir):
+    if not is_commit_id(repo.refspec):
+        return
+    filename = _snapshot_file(snapshot_dir, repo, repo.refspec)
+    if os.path.exists(filename):
+        return
+
+    state = get_repo_state(repo.path)
+    if state.head() != repo.refspec or \
+       state.git_dir != os.path.join(repo.path, '.git'):
+        logging.debug('Not storing snapshot of repository %s', repo.name)
+        return
+    if os.path.exists(os.path.join(state.git_dir, 'objects', 'info',
+                                   'alternates')):
+        logging.info('Not storing snapshot of repository %s, as it borrows '
+                     'objects from another repository', repo.name)
+        return
+
+    (retc, output) = yield from run_cmd_async(['git', 'status',
+                                               '--porcelain'],
+                                              env=config.environ,
+                                              cwd=repo.path,
+                                              fail=False,
+                                              liveupdate=False)
+    if retc or output.strip():
+        logging.debug('Not storing snapshot of modified repository %s',
+                      repo.name)
+        return
+
+    loop = asyncio.get_event_loop()
+    try:
+        yield from loop.run_in_executor(None, _store, repo, filename)
+    except (IOError, OSError, tarfile.TarError,
+            subprocess.CalledProcessError) as err:
+        logging.warning('Could not store snapshot of repository %s: %s',
+                        repo.name, err)
+        return
+    logging.info('Snapshot of repository %s stored', repo.name)
+
+
+def _run_all(coros, jobs):
+    slots = asyncio.Semaphore(jobs or FETCH_JOBS)
+
+    @asyncio.coroutine
+    def _run(coro):
+        with (yield from slots):
+            yield from coro
+
+    tasks = [_ensure_future(_run(coro)) for coro in coros]
+    if tasks:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.wait(tasks))
+        for task in tasks:
+            task.result()
+
+
+def snapshots_restore(config, repos, jobs=None, scheduler=None):
+    """
+        Restores the missing repositories that are pinned to a commit from
+        the snapshot directory, running up to jobs restores concurrently.
+        Repositories without a usable snapshot are left to be fetched.
+        Repositories whose fetch was already started through the scheduler
+        restored their snapshot before and are skipped.
+    """
+    snapshot_dir = config.get_repo_snapshot_dir()
+    if not snapshot_dir:
+        return
+    _run_all([_snapshot_restore_async(repo, snapshot_dir)
+              for repo in repos
+              if not (scheduler and scheduler.started(repo))], jobs)
+
+
+def snapshots_store(config, repos, jobs=None):
+    """
+        Stores snapshots of the checked out repositories that are pinned to
+        a commit and not yet in the snapshot directory.
+    """
+    snapshot_dir = config.get_repo_snapshot_dir()
+    if not snapshot_dir:
+        return
+    _run_all([_snapshot_store_async(config, repo, snapshot_dir)
+              for repo in repos], jobs)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    Measures how long loading kas configuration files takes, for the
+    validators, the parser backends, merging and whole trees of include
+    files.
+
+    Usage: scripts/benchmark_config.py [--repos N] [--files N]
+                                       [--includes N [N ...]] [--runs N]
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tempfile
+import functools
+import subprocess
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from kas import CONFIGSCHEMA  # noqa: E402
+from kas import includehandler  # noqa: E402
+from kas.configschema import get_validator  # noqa: E402
+from kas.configcache import ConfigCache  # noqa: E402
+
+
+def make_config(repos, offset=0, includes=None):
+    """
+        Returns a configuration with the given number of repositories.
+    """
+    return {
+        'header': {
+            'version': 7,
+            'includes': includes or [],
+        },
+        'machine': 'qemux86-64',
+        'distro': 'poky',
+        'target': ['core-image-minimal'],
+        'env': {'VAR{}'.format(i): 'value' for i in range(10)},
+        'repos': {
+            'repo{}'.format(i): {
+                'url': 'https://example.com/repo{}.git'.format(i),
+                'refspec': 'master',
+                'layers': {'meta-{}'.format(j): None for j in range(5)},
+            } for i in range(offset, offset + repos)
+        },
+        'local_conf_header': {'line{}'.format(i): 'X = "1"'
+                              for i in range(20)},
+    }
+
+
+def make_tree(directory, ext, files, repos):
+    """
+        Writes a top configuration file that includes the given number of
+        files, each defining its own repositories. Returns the path of the
+        top file.
+    """
+    names = ['include{}{}'.format(i, ext) for i in range(files)]
+    for (i, name) in enumerate(names):
+        write_config(os.path.join(directory, name), make_config(repos, i))
+    top = os.path.join(directory, 'top' + ext)
+    write_config(top, make_config(repos, files, names))
+    return top
+
+
+def write_config(filename, config):
+    """
+        Writes the configuration as JSON or YAML, depending on the file
+        extension.
+    """
+    with open(filename, 'w') as fds:
+        if filename.endswith('.json'):
+            json.dump(config, fds, indent=4)
+        else:
+            yaml.safe_dump(config, fds, default_flow_style=False)
+
+
+def report(name, seconds, runs):
+    """
+        Prints the time of a single run of the measurement.
+    """
+    print('  {:<38} {:10.1f} us'.format(name, seconds / runs * 1e6))
+
+
+def import_time(module):
+    """
+        Returns the time needed to import the module in a new interpreter.
+    """
+    code = 'import time; t = time.perf_counter(); import {}; ' \
+           'print(time.perf_counter() - t)'.format(module)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return float(output)
+
+
+def parsers():
+    """
+        Returns the available parser backends by file extension.
+    """
+    backends = {'.yml': [('PyYAML',
+                          lambda c: yaml.load(c, Loader=yaml.SafeLoader))],
+                '.json': [('json', lambda c: json.loads(c.decode('utf-8')))]}
+    if hasattr(yaml, 'CSafeLoader'):
+        backends['.yml'].append(
+            ('libyaml', lambda c: yaml.load(c, Loader=yaml.CSafeLoader)))
+    try:
+        import orjson
+        backends['.json'].append(('orjson', orjson.loads))
+    except ImportError:
+        pass
+    return backends
+
+
+def bench_validators(config, runs):
+    """
+        Compares jsonschema with the compiled validator kas uses.
+    """
+    from jsonschema.validators import Draft4Validator
+    report('jsonschema Draft4Validator',
+           timeit.timeit(lambda: list(Draft4Validator(CONFIGSCHEMA)
+                                      .iter_errors(config)),
+                         number=runs), runs)
+    is_valid = get_validator(CONFIGSCHEMA)
+    report('compiled validator',
+           timeit.timeit(lambda: is_valid(config), number=runs), runs)
+    report('import jsonschema', import_time('jsonschema'), 1)
+
+
+def bench_parsers(config, runs):
+    """
+        Compares the available parser backends on the same configuration.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        for (ext, backends) in sorted(parsers().items()):
+            filename = os.path.join(directory, 'config' + ext)
+            write_config(filename, config)
+            with open(filename, 'rb') as fds:
+                content = fds.read()
+            for (name, parse) in backends:
+                report('{} ({} kB)'.format(name, len(content) // 1024),
+                       timeit.timeit(lambda p=parse, c=content: p(c),
+                                     number=runs), runs)
+        print('  kas uses {} and {}'.format(
+            includehandler.get_parser('.yml')[0],
+            includehandler.get_parser('.json')[0]))
+
+
+def fold_merge(dest, upd):
+    """
+        Merges like kas did before merge_configs, copying the result at
+        every step and level.
+    """
+    dest = OrderedDict(dest)
+    for key in upd:
+        if isinstance(dest.get(key), Mapping) and \
+                isinstance(upd[key], Mapping):
+            dest[key] = fold_merge(dest[key], upd[key])
+        else:
+            dest[key] = upd[key]
+    return dest
+
+
+def bench_merge(includes, repos, runs):
+    """
+        Compares merge_configs with a pairwise merge of the configurations.
+    """
+    for count in includes:
+        # Every configuration adds its own repositories and lines to the
+        # merged ones
+        configs = [make_config(repos, i * repos) for i in range(count)]
+        for (i, config) in enumerate(configs):
+            config['local_conf_header'] = {
+                'file{}-line{}'.format(i, j): 'X = "1"' for j in range(20)}
+        report('{} configs, fold'.format(count),
+               timeit.timeit(lambda c=configs: functools.reduce(fold_merge,
+                                                                c),
+                             number=runs), runs)
+        report('{} configs, merge_configs'.format(count),
+               timeit.timeit(lambda c=configs: includehandler.merge_configs(
+                   c), number=runs), runs)
+
+
+def bench_tree(files, repos, runs):
+    """
+        Measures loading a tree of include files, with and without the
+        configuration cache.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, 'cache')
+        for ext in ['.yml', '.json']:
+            top = make_tree(directory, ext, files, repos)
+            report('{} files{}'.format(files + 1, ext),
+                   timeit.timeit(lambda t=top: includehandler.GlobalIncludes(
+                       t).get_config(), number=runs), runs)
+            includehandler.GlobalIncludes(top,
+                                          ConfigCache(cache_dir)).get_config()
+            report('{} files{}, cached'.format(files + 1, ext),
+                   timeit.timeit(lambda t=top: includehandler.GlobalIncludes(
+                       t, ConfigCache(cache_dir)).get_config(),
+                                 number=runs), runs)
+
+
+def main():
+    """
+        Runs all measurements with the sizes given on the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repos', type=int, default=40,
+                        help='Number of repositories per file')
+    parser.add_argument('--files', type=int, default=30,
+                        help='Number of included files')
+    parser.add_argument('--includes', type=int, nargs='+',
+                        default=[10, 100, 300],
+                        help='Numbers of configurations to merge')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Number of runs per measurement')
+    args = parser.parse_args()
+    config = make_config(args.repos)
+
+    print('Validating a configuration with {} repositories'
+          .format(args.repos))
+    bench_validators(config, args.runs)
+
+    print('Parsing a configuration with {} repositories'.format(args.repos))
+    bench_parsers(config, args.runs)
+
+    print('Merging configurations with {} repositories each'
+          .format(args.repos))
+    bench_merge(args.includes, args.repos, max(args.runs // 10, 1))
+
+    print('Loading a tree of {} files with {} repositories each'
+          .format(args.files + 1, args.repos))
+    bench_tree(args.files, args.repos, max(args.runs // 10, 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring
+
+import os
+import subprocess
+
+import pytest
+
+
+def git(path, *args):
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME='kas', GIT_AUTHOR_EMAIL='kas@example.com',
+               GIT_COMMITTER_NAME='kas', GIT_COMMITTER_EMAIL='kas@example.com')
+    return subprocess.check_output(['git'] + list(args), cwd=path,
+                                   env=env).decode('utf-8').strip()
+
+
+def write(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as fds:
+        fds.write(content)
+
+
+@pytest.fixture
+def remote(tmpdir):
+    path = str(tmpdir.join('remote'))
+    write(os.path.join(path, 'meta-a', 'conf', 'layer.conf'), 'a\n')
+    write(os.path.join(path, 'meta-b', 'conf', 'layer.conf'), 'b\n')
+    git(str(tmpdir), 'init', '-q', path)
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'first')
+    git(path, 'tag', 'first')
+    write(os.path.join(path, 'README'), 'second\n')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'second')
+    return path
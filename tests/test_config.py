@@ -0,0 +1,296 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use
+
+import os
+import asyncio
+
+import pytest
+
+from conftest import git, write
+from kas import config
+from kas.config import Context, ConfigUnion, create_context
+from kas.libgit import FetchScheduler, repos_fetch_checkout
+from kas.repos import Repo
+
+
+class StaticConfig(object):
+    def __init__(self, repos):
+        self.repos = repos
+        self.build_dir = 'build-' + str(len(repos))
+
+    def get_repos(self):
+        return self.repos
+
+
+def repo(name, refspec='master', sparse=None, path=None):
+    return Repo(url='https://example.com/{}.git'.format(name),
+                path=path or '/work/' + name, refspec=refspec,
+                sparse=sparse)
+
+
+class TestConfigUnion(object):
+    def test_union(self):
+        first = StaticConfig([repo('a'), repo('b', sparse=['meta-b'])])
+        second = StaticConfig([repo('b', sparse=['meta-c']), repo('c'),
+                               repo('a', path='/other/a')])
+        union = ConfigUnion([first, second])
+        repos = union.get_repos()
+        assert [r.path for r in repos] == \
+            ['/work/a', '/work/b', '/work/c', '/other/a']
+        assert repos[0] is first.repos[0]
+        assert repos[1].sparse == ['meta-b', 'meta-c']
+        # The configurations are not modified
+        assert first.repos[1].sparse == ['meta-b']
+        assert union.build_dir == first.build_dir
+
+    def test_full_checkout_wins(self):
+        union = ConfigUnion([StaticConfig([repo('a', sparse=['meta-a'])]),
+                             StaticConfig([repo('a')])])
+        assert union.get_repos()[0].sparse is None
+
+    def test_conflict(self):
+        union = ConfigUnion([StaticConfig([repo('a')]),
+                             StaticConfig([repo('a', refspec='next')])])
+        with pytest.raises(SystemExit):
+            union.get_repos()
+
+
+def test_build_dir():
+    assert Context(work_dir='/work').build_dir == '/work/build'
+    assert Context(work_dir='/work', build_dir='build-a').build_dir == \
+        '/work/build-a'
+
+
+def test_multiconfig(monkeypatch):
+    monkeypatch.delenv('KAS_TARGET', raising=False)
+    targets = ['multiconfig:qemuarm:image', 'core-image-minimal',
+               'multiconfig:qemux86:image', 'multiconfig:qemuarm:sdk']
+    for config in [{'target': targets}, {'target': targets[::-1]}]:
+        assert Context(work_dir='/work', config=config).get_multiconfig() \
+            == 'qemuarm qemux86'
+
+
+class TestRepoDict(object):
+    config = {'repos': {'a': {'url': 'git@example.com:a.git',
+                              'refspec': 'master',
+                              'layers': {'meta-a': None,
+                                         'meta-b': 'disabled'}}}}
+
+    def test_repo(self):
+        repo = Context(work_dir='/work', config=self.config).get_repos()[0]
+        assert repo.path == '/work/a'
+        assert repo.layers == ['/work/a/meta-a']
+        assert repo.qualified_name == 'git.example.com.a.git'
+        assert repo.host == 'example.com'
+
+    def test_shared(self):
+        shared = [Repo(url='git@example.com:a.git', path='/other/a',
+                       refspec='master')]
+        context = Context(work_dir='/work', config=self.config,
+                          shared_repos=shared)
+        assert context.get_repos()[0].path == '/other/a'
+        shared[0].refspec = 'next'
+        context.set_config(self.config)
+        assert context.get_repos()[0].path == '/work/a'
+
+    def test_cached(self):
+        context = Context(work_dir='/work', config=self.config)
+        repo = context.get_repos()[0]
+        assert context.get_repos()[0] is repo
+        context.set_repo_lock({'a': {'url': 'git@example.com:a.git',
+                                     'refspec': 'master',
+                                     'commit': '0' * 40}})
+        assert context.get_repos()[0].refspec == '0' * 40
+        context.set_config({'repos': {}})
+        assert context.get_repos() == []
+
+
+@pytest.mark.parametrize('layers,includes,expected', [
+    (['meta-b', 'meta-a/'], [], ['meta-a', 'meta-b']),
+    (['meta/./a', 'meta/a'], [], ['meta/a']),
+    (['meta-a'], ['kas/a.yml', 'kas/b.yml', 'top.yml'], ['kas', 'meta-a']),
+    (['meta-a', '.'], [], None),
+    ([''], [], None),
+    ([], ['kas/a.yml'], None),
+])
+def test_sparse_dirs(layers, includes, expected):
+    assert config._get_sparse_dirs(layers, includes) == expected
+
+
+def test_sparse_layers():
+    def sparse(layers):
+        context = Context(work_dir='/work', config={'repos': {'a': {
+            'url': 'git@example.com:a.git', 'refspec': 'master',
+            'sparse': True, 'layers': layers}}})
+        context.set_repo_includes({'a': ['kas/a.yml']})
+        return context.get_repos()[0]
+
+    repo = sparse({'meta-a': None, 'meta-b': 'disabled'})
+    assert repo.sparse == ['kas', 'meta-a']
+    assert repo.clone == 'blobless'
+    assert sparse({'meta-a': None, 'meta-b': None}).sparse == \
+        ['kas', 'meta-a', 'meta-b']
+    assert sparse({}).sparse is None
+
+
+class TestLoadConfiguration(object):
+    top_config = """header:
+  version: 7
+  includes:
+    - repo: ext
+      file: kas/ext.yml
+distro: top
+repos:
+  ext:
+    url: file://{0}
+    refspec: master
+    layers:
+      meta-ext:
+  other:
+    url: file://{0}
+    refspec: master
+"""
+
+    @pytest.fixture
+    def top(self, remote, tmpdir):
+        write(os.path.join(remote, 'meta-ext', 'conf', 'layer.conf'), '')
+        write(os.path.join(remote, 'kas', 'ext.yml'),
+              'header:\n  version: 7\nmachine: from-ext\n')
+        git(remote, 'add', '-A')
+        git(remote, 'commit', '-q', '-m', 'ext')
+        filename = str(tmpdir.join('project', 'kas.yml'))
+        write(filename, self.top_config.format(remote))
+        os.makedirs(str(tmpdir.join('work')))
+        return filename
+
+    @staticmethod
+    def load(top, tmpdir, **kwargs):
+        return create_context(top, work_dir=str(tmpdir.join('work')),
+                              os_environ={'PATH': os.environ['PATH']},
+                              **kwargs)
+
+    def test_include_from_repo(self, remote, top, tmpdir):
+        scheduler = FetchScheduler()
+        context = self.load(top, tmpdir, scheduler=scheduler)
+        work = str(tmpdir.join('work'))
+        assert context.get_machine() == 'from-ext'
+        assert context.get_distro() == 'top'
+        repos = context.get_repo_dict()
+        assert repos['ext'].layers == [os.path.join(work, 'ext', 'meta-ext')]
+        assert git(repos['ext'].path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'HEAD')
+        # Repos without includes are only fetched, and the fetch is left to
+        # the repos_fetch_checkout step
+        assert scheduler.started(repos['other'])
+        repos_fetch_checkout(context, context.get_repos(),
+                             scheduler=scheduler)
+        assert git(repos['other'].path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'HEAD')
+
+    def test_without_prefetch(self, top, tmpdir):
+        scheduler = FetchScheduler()
+        context = self.load(top, tmpdir, scheduler=scheduler,
+                            prefetch_repos=False)
+        repos = context.get_repo_dict()
+        assert scheduler.started(repos['ext'])
+        assert not scheduler.started(repos['other'])
+
+    def test_include_chain(self, tmpdir, monkeypatch):
+        events = []
+        fetch = config._repo_fetch_async
+
+        @asyncio.coroutine
+        def _fetch(context, repo):
+            events.append(('start', repo.name))
+            yield from asyncio.sleep(0.1)
+            retc = yield from fetch(context, repo)
+            events.append(('end', repo.name))
+            return retc
+
+        monkeypatch.setattr(config, '_repo_fetch_async', _fetch)
+        remotes = {}
+        for (name, content) in [
+                ('r1', 'header:\n  version: 7\n  includes:\n'
+                       '    - repo: r2\n      file: b.yml\n'),
+                ('r2', 'header:\n  version: 7\nmachine: from-r2\n')]:
+            path = str(tmpdir.join(name))
+            write(os.path.join(path, 'a.yml' if name == 'r1' else 'b.yml'),
+                  content)
+            git(str(tmpdir), 'init', '-q', path)
+            git(path, 'add', '-A')
+            git(path, 'commit', '-q', '-m', 'first')
+            remotes[name] = path
+        top = str(tmpdir.join('project', 'kas.yml'))
+        write(top, 'header:\n  version: 7\n  includes:\n'
+                   '    - repo: r1\n      file: a.yml\n'
+                   'repos:\n'
+                   '  r1:\n    url: file://{r1}\n    refspec: master\n'
+                   '  r2:\n    url: file://{r2}\n    refspec: master\n'
+              .format(**remotes))
+        os.makedirs(str(tmpdir.join('work')))
+
+        assert self.load(top, tmpdir).get_machine() == 'from-r2'
+        # r2 is fetched as soon as kas.yml lists it, not only once the
+        # include from r1 needs it
+        assert events.index(('start', 'r2')) < events.index(('end', 'r1'))
+
+    def test_lock(self, remote, top, tmpdir):
+        first = git(remote, 'rev-parse', 'HEAD')
+        write(os.path.join(remote, 'kas', 'ext.yml'),
+              'header:\n  version: 7\nmachine: second\n')
+        git(remote, 'commit', '-q', '-a', '-m', 'second')
+        write(str(tmpdir.join('project', 'kas.lock')),
+              '{{"repos": {{"ext": {{"url": "file://{}", '
+              '"refspec": "master", "commit": "{}"}}}}}}'
+              .format(remote, first))
+
+        context = self.load(top, tmpdir)
+        assert context.get_machine() == 'from-ext'
+        assert git(context.get_repo_dict()['ext'].path,
+                   'rev-parse', 'HEAD') == first
+
+        assert self.load(top, tmpdir, use_lock=False).get_machine() == \
+            'second'
+
+    def test_without_git(self, top, tmpdir):
+        with pytest.raises(SystemExit):
+            self.load(top, tmpdir, prepare_repos=False)
+        write(str(tmpdir.join('work', 'ext', 'kas', 'ext.yml')),
+              'header:\n  version: 7\nmachine: checkout\n')
+        context = self.load(top, tmpdir, prepare_repos=False)
+        assert context.get_machine() == 'checkout'
+
+    def test_shared_conflict(self, remote, top, tmpdir):
+        first = self.load(top, tmpdir)
+        head = git(first.get_repo_dict()['ext'].path, 'rev-parse', 'HEAD')
+        git(remote, 'checkout', '-q', '-b', 'next')
+        git(remote, 'commit', '-q', '--allow-empty', '-m', 'next')
+        other = str(tmpdir.join('project', 'other.yml'))
+        write(other, self.top_config.format(remote)
+              .replace('refspec: master', 'refspec: next'))
+        with pytest.raises(SystemExit):
+            self.load(other, tmpdir, shared_repos=first.get_repos())
+        # The conflict is found before the checkout is changed
+        assert git(first.get_repo_dict()['ext'].path,
+                   'rev-parse', 'HEAD') == head
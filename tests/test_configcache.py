@@ -0,0 +1,107 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+# pylint: disable=protected-access
+
+import pickle
+
+import pytest
+
+from kas import includehandler
+from kas.configcache import ConfigCache
+
+
+@pytest.fixture
+def config_file(tmpdir):
+    filename = tmpdir.join('config.yml')
+    filename.write('header:\n  version: 7\nmachine: qemux86\n')
+    return str(filename)
+
+
+def fail(*_args, **_kwargs):
+    raise AssertionError('configuration was parsed again')
+
+
+class TestConfigCache(object):
+    def test_unchanged(self, config_file, tmpdir, monkeypatch):
+        cachedir = str(tmpdir.join('cache'))
+        config = includehandler.load_config(config_file,
+                                            ConfigCache(cachedir))
+        assert config['machine'] == 'qemux86'
+
+        # A new cache instance reads the entry from disk
+        monkeypatch.setattr(includehandler, 'get_parser', fail)
+        monkeypatch.setattr(includehandler, 'get_validator', fail)
+        cache = ConfigCache(cachedir)
+        assert includehandler.load_config(config_file, cache) == config
+
+        # Callers get their own copy
+        includehandler.load_config(config_file, cache)['machine'] = 'x'
+        assert includehandler.load_config(config_file, cache) == config
+
+    def test_changed(self, config_file, tmpdir):
+        cache = ConfigCache(str(tmpdir.join('cache')))
+        includehandler.load_config(config_file, cache)
+        with open(config_file, 'a') as fds:
+            fds.write('distro: poky\n')
+        config = includehandler.load_config(config_file, cache)
+        assert config['distro'] == 'poky'
+
+    def test_invalid_not_cached(self, tmpdir):
+        cache = ConfigCache(str(tmpdir.join('cache')))
+        filename = str(tmpdir.join('invalid.yml'))
+        with open(filename, 'w') as fds:
+            fds.write('header:\n  version: 7\nmachine: [1]\n')
+        for _ in range(2):
+            with pytest.raises(includehandler.LoadConfigException):
+                includehandler.load_config(filename, cache)
+
+    def test_unwritable(self, config_file, tmpdir):
+        blocker = tmpdir.join('file')
+        blocker.write('')
+        cache = ConfigCache(str(blocker.join('cache')))
+        config = includehandler.load_config(config_file, cache)
+        assert config['machine'] == 'qemux86'
+
+    @pytest.mark.parametrize('entry', [
+        lambda key: b'not a pickle',
+        lambda key: pickle.dumps(['key', 'config']),
+        lambda key: pickle.dumps({'config': b''}),
+        # The configuration refers to a module that does not exist
+        lambda key: pickle.dumps({'key': key,
+                                  'config': b'\x80\x03ckas.missing\nX\n.'}),
+    ])
+    def test_corrupt_entry(self, config_file, tmpdir, entry):
+        cachedir = str(tmpdir.join('cache'))
+        cache = ConfigCache(cachedir)
+        config = includehandler.load_config(config_file, cache)
+        with open(config_file) as fds:
+            content = fds.read()
+        with open(cache._entry_file(config_file), 'wb') as fds:
+            fds.write(entry(cache._key(content)))
+
+        cache = ConfigCache(cachedir)
+        assert cache.get(config_file, content) is None
+        assert includehandler.load_config(config_file, cache) == config
+        # The entry was replaced by a valid one
+        assert ConfigCache(cachedir).get(config_file, content) == config
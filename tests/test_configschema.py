@@ -0,0 +1,182 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+
+import copy
+import random
+
+import pytest
+from jsonschema.validators import Draft4Validator
+
+from kas import CONFIGSCHEMA
+from kas.configschema import get_validator
+
+VALID = [
+    {'header': {'version': 7}},
+    {'header': {'version': '0.10'}},
+    {
+        'header': {
+            'version': 7,
+            'includes': ['base.yml', {'repo': 'meta', 'file': 'inc.yml'}],
+        },
+        'machine': 'qemux86',
+        'distro': 'poky',
+        'target': ['core-image-minimal', 'core-image-base'],
+        'task': 'build',
+        'env': {'VAR': 'value'},
+        'repos': {
+            'this': None,
+            'poky': {
+                'url': 'https://git.yoctoproject.org/git/poky',
+                'refspec': 'master',
+                'clone': 'blobless',
+                'sparse': True,
+                'layers': {
+                    'meta': None,
+                    'meta-poky': 1,
+                    'meta-yocto-bsp': False,
+                    'meta-skeleton': 'disabled',
+                },
+            },
+            'local': {'path': '/src/meta-local', 'name': 'local'},
+        },
+        'bblayers_conf_header': {'base': 'BBPATH = "${TOPDIR}"'},
+        'local_conf_header': {'base': 'CONF_VERSION = "1"'},
+        'proxy_config': {'http_proxy': 'http://proxy:3128'},
+    },
+]
+
+INVALID = [
+    {},
+    [],
+    None,
+    'header',
+    {'header': {}},
+    {'header': {'version': '7'}},
+    {'header': {'version': 7.0}},
+    {'header': {'version': True}},
+    {'header': {'version': 7, 'extra': 1}},
+    {'header': {'version': 7, 'includes': 'base.yml'}},
+    {'header': {'version': 7, 'includes': [{'repo': 'meta'}]}},
+    {'header': {'version': 7, 'includes': [{'repo': 'a', 'file': 'b',
+                                            'c': 'd'}]}},
+    {'header': {'version': 7, 'includes': [1]}},
+    {'header': {'version': 7}, 'unknown': 1},
+    {'header': {'version': 7}, 'machine': 1},
+    {'header': {'version': 7}, 'target': [1]},
+    {'header': {'version': 7}, 'target': {}},
+    {'header': {'version': 7}, 'env': {'VAR': 1}},
+    {'header': {'version': 7}, 'repos': []},
+    {'header': {'version': 7}, 'repos': {'r': 'url'}},
+    {'header': {'version': 7}, 'repos': {'r': {'url': 1}}},
+    {'header': {'version': 7}, 'repos': {'r': {'clone': 'deep'}}},
+    {'header': {'version': 7}, 'repos': {'r': {'sparse': 'yes'}}},
+    {'header': {'version': 7}, 'repos': {'r': {'unknown': 'x'}}},
+    {'header': {'version': 7}, 'repos': {'r': {'layers': {'l': []}}}},
+    {'header': {'version': 7}, 'repos': {'r': {'layers': {'l': 1.5}}}},
+    {'header': {'version': 7}, 'proxy_config': {'other_proxy': 'x'}},
+]
+
+SAMPLES = [None, True, False, 0, 1, 1.5, '', '0.10', 'string', [], ['a'],
+           [1], {}, {'a': 'b'}, {'a': 1}]
+
+
+def jsonschema_valid(instance):
+    return not list(Draft4Validator(CONFIGSCHEMA).iter_errors(instance))
+
+
+def mutations(config, rand):
+    """
+        Yields variants of the configuration with one value, at any depth,
+        replaced by a sample value or removed.
+    """
+    paths = []
+
+    def _collect(node, path):
+        if isinstance(node, dict):
+            for key in node:
+                paths.append(path + [key])
+                _collect(node[key], path + [key])
+        elif isinstance(node, list):
+            for index in range(len(node)):
+                paths.append(path + [index])
+                _collect(node[index], path + [index])
+    _collect(config, [])
+
+    for path in paths:
+        for _ in range(4):
+            variant = copy.deepcopy(config)
+            node = variant
+            for key in path[:-1]:
+                node = node[key]
+            if rand.random() < 0.2:
+                del node[path[-1]]
+            else:
+                node[path[-1]] = copy.deepcopy(rand.choice(SAMPLES))
+            yield variant
+
+
+def test_compiled():
+    assert get_validator(CONFIGSCHEMA) is not None
+    assert get_validator(CONFIGSCHEMA) is get_validator(CONFIGSCHEMA)
+
+
+@pytest.mark.parametrize('config', VALID)
+def test_valid(config):
+    assert jsonschema_valid(config)
+    assert get_validator(CONFIGSCHEMA)(config)
+
+
+@pytest.mark.parametrize('config', INVALID)
+def test_invalid(config):
+    assert not jsonschema_valid(config)
+    assert not get_validator(CONFIGSCHEMA)(config)
+
+
+def test_agrees_with_jsonschema():
+    is_valid = get_validator(CONFIGSCHEMA)
+    rand = random.Random(0)
+    checked = 0
+    for config in VALID:
+        for variant in mutations(config, rand):
+            assert is_valid(variant) == jsonschema_valid(variant), variant
+            checked += 1
+    assert checked > 100
+
+
+def test_unsupported_keyword():
+    assert get_validator({'type': 'string', 'pattern': '^a'}) is None
+    assert get_validator({'enum': [1, 'a']}) is None
+    assert get_validator({'items': [{'type': 'string'}]}) is None
+
+
+def test_errors_reported_by_jsonschema(tmpdir, caplog):
+    from kas import includehandler
+    config = {'header': {'version': 7}, 'machine': 1, 'unknown': 1}
+    filename = tmpdir.join('invalid.json')
+    filename.write('{"header": {"version": 7}, "machine": 1, "unknown": 1}')
+    with pytest.raises(includehandler.LoadConfigException):
+        includehandler.load_config(str(filename))
+    expected = ['Config file validation Error:\n{}'.format(error)
+                for error in Draft4Validator(CONFIGSCHEMA).iter_errors(config)]
+    assert [record.getMessage() for record in caplog.records] == expected
@@ -24,8 +24,14 @@
 
 import os
 import io
+import copy
+import json
+import random
+import time
 import textwrap
+import functools
 import contextlib
+from collections import OrderedDict, Mapping
 
 import pytest
 
@@ -59,6 +65,29 @@ def patch_open(component, string='', dictionary=None):
         del component.open
 
 
+class TestParsers(object):
+    def test_yaml(self):
+        import yaml
+        content = 'a: [1, 2.5, "x", null, true]\nb: {c: d}\n'
+        (_, parse) = includehandler.get_parser('.yml')
+        assert parse(content) == yaml.safe_load(content)
+        assert parse(content.encode('utf-8')) == yaml.safe_load(content)
+
+    def test_json(self):
+        import json
+        content = '{"a": [1, 2.5, "x", null, true], "b": {"c": "d"}}'
+        (_, parse) = includehandler.get_parser('.json')
+        assert parse(content) == json.loads(content)
+        assert parse(content.encode('utf-8')) == json.loads(content)
+
+    def test_json_fallback(self):
+        (_, parse) = includehandler.get_parser('.json')
+        value = parse(b'{"a": NaN}')['a']
+        assert value != value
+        with pytest.raises(ValueError):
+            parse(b'{"a": }')
+
+
 class TestLoadConfig(object):
     def test_err_invalid_ext(self):
         # Test for invalid file extension:
@@ -363,3 +392,172 @@ v: {v3: z, v4: z}''')}):
             assert index['v2'] < index['v1']
             assert index['v3'] < index['v1']
             assert index['v5'] < index['v1']
+
+    def test_diamond_loaded_once(self, monkeypatch):
+        monkeypatch.setattr(includehandler, 'CONFIGSCHEMA', {})
+        header = self.__class__.header
+        loaded = []
+        load_config = includehandler.load_config
+
+        def _load_config(filename, cache=None):
+            loaded.append(filename)
+            return load_config(filename, cache)
+        monkeypatch.setattr(includehandler, 'load_config', _load_config)
+        with patch_open(includehandler, dictionary={
+            'x.yml': header.format('''  includes: ["y.yml", "z.yml"]
+v: {v1: x}'''),
+            os.path.abspath('y.yml'): header.format('''  includes: ["b.yml"]
+v: {v1: y, v2: y}'''),
+            os.path.abspath('z.yml'): header.format('''  includes: ["b.yml"]
+v: {v3: z}'''),
+            os.path.abspath('b.yml'): header.format('''
+v: {v2: b, v3: b, v4: b}''')}):
+            ginc = includehandler.GlobalIncludes('x.yml')
+            config, _ = ginc.get_config()
+        assert sorted(loaded) == sorted(['x.yml', os.path.abspath('y.yml'),
+                                         os.path.abspath('z.yml'),
+                                         os.path.abspath('b.yml')])
+        # b.yml is merged again after y.yml, as before
+        assert dict(config['v']) == {'v1': 'x', 'v2': 'b', 'v3': 'z',
+                                     'v4': 'b'}
+
+    def test_cycle(self, monkeypatch):
+        monkeypatch.setattr(includehandler, 'CONFIGSCHEMA', {})
+        header = self.__class__.header
+        with patch_open(includehandler, dictionary={
+                'x.yml': header.format('  includes: ["y.yml"]'),
+                os.path.abspath('y.yml'): header.format(
+                    '  includes: ["z.yml"]'),
+                os.path.abspath('z.yml'): header.format(
+                    '  includes: ["y.yml"]')}):
+            ginc = includehandler.GlobalIncludes('x.yml')
+            with pytest.raises(includehandler.IncludeException) as error:
+                ginc.get_config()
+        assert str(error.value) == \
+            'Include cycle detected: {0} -> {1} -> {0}'.format(
+                os.path.realpath('y.yml'), os.path.realpath('z.yml'))
+
+    def test_incremental_rounds(self, monkeypatch):
+        monkeypatch.setattr(includehandler, 'CONFIGSCHEMA', {})
+        header = self.__class__.header
+        loaded = []
+        load_config = includehandler.load_config
+
+        def _load_config(filename, cache=None):
+            loaded.append(filename)
+            return load_config(filename, cache)
+        monkeypatch.setattr(includehandler, 'load_config', _load_config)
+        files = {
+            'x.yml': header.format('''  includes: ["y.yml", "z.yml"]
+v: {v1: x}'''),
+            os.path.abspath('y.yml'): header.format('''
+  includes: [{repo: rep, file: a.yml}]
+v: {v2: y}'''),
+            os.path.abspath('z.yml'): header.format('''
+v: {v3: z}'''),
+            '/rep/a.yml': header.format('''
+  includes: [{repo: rep2, file: b.yml}]
+v: {v2: a, v4: a}'''),
+            '/rep2/b.yml': header.format('''
+v: {v5: b}''')}
+        rounds = [({}, ['rep'], ['x.yml', os.path.abspath('y.yml'),
+                                 os.path.abspath('z.yml')]),
+                  ({'rep': '/rep'}, ['rep2'], ['/rep/a.yml']),
+                  ({'rep': '/rep', 'rep2': '/rep2'}, [], ['/rep2/b.yml']),
+                  ({'rep': '/rep', 'rep2': '/rep2'}, [], [])]
+        with patch_open(includehandler, dictionary=files):
+            ginc = includehandler.GlobalIncludes('x.yml')
+            for (repos, missing, files_loaded) in rounds:
+                del loaded[:]
+                config, missing_repos = ginc.get_config(repos=repos)
+                assert missing_repos == missing
+                assert sorted(loaded) == sorted(files_loaded)
+                fresh, _ = includehandler.GlobalIncludes('x.yml') \
+                    .get_config(repos=repos)
+                assert config == fresh
+        assert dict(config['v']) == {'v1': 'x', 'v2': 'y', 'v3': 'z',
+                                     'v4': 'a', 'v5': 'b'}
+
+    def test_parallel_siblings(self, monkeypatch):
+        monkeypatch.setattr(includehandler, 'CONFIGSCHEMA', {})
+        header = self.__class__.header
+        names = ['y{}.yml'.format(i) for i in range(6)]
+        files = {'x.yml': header.format('  includes: {}\nv: {{x: x}}'
+                                        .format(json.dumps(names)))}
+        for (i, name) in enumerate(names):
+            files[os.path.abspath(name)] = header.format(
+                '\nv: {{x: {0}, {0}: {0}}}'.format(i))
+        active = []
+        overlapped = []
+        load_config = includehandler.load_config
+
+        def _load_config(filename, cache=None):
+            active.append(filename)
+            overlapped.append(len(active))
+            # The first includes take longest
+            if os.path.basename(filename) in names:
+                time.sleep(0.01 * (len(names) - names.index(
+                    os.path.basename(filename))))
+            active.remove(filename)
+            return load_config(filename, cache)
+        monkeypatch.setattr(includehandler, 'load_config', _load_config)
+        with patch_open(includehandler, dictionary=files):
+            config, _ = includehandler.GlobalIncludes('x.yml').get_config()
+        assert max(overlapped) > 1
+        assert json.dumps(config['v']) == \
+            '{"x": "x", "0": 0, "1": 1, "2": 2, "3": 3, "4": 4, "5": 5}'
+
+
+def reference_merge(dest, upd):
+    # The merge as done before merge_configs, one copy per step and level
+    dest = OrderedDict(dest)
+    for key in upd:
+        if isinstance(dest.get(key), Mapping) and \
+                isinstance(upd[key], Mapping):
+            dest[key] = reference_merge(dest[key], upd[key])
+        else:
+            dest[key] = upd[key]
+    return dest
+
+
+def random_config(rand, depth=0):
+    config = {}
+    for _ in range(rand.randint(0, 4)):
+        key = rand.choice('abcdef')
+        if depth < 3 and rand.random() < 0.4:
+            config[key] = random_config(rand, depth + 1)
+        else:
+            config[key] = rand.choice([None, 1, 'x', ['l'], 'y'])
+    return config
+
+
+class TestMergeConfigs(object):
+    def test_reference(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            configs = [random_config(rand)
+                       for _ in range(rand.randint(1, 8))]
+            original = copy.deepcopy(configs)
+            expected = functools.reduce(reference_merge, configs)
+            result = includehandler.merge_configs(configs)
+            assert result == expected
+            assert json.dumps(result) == json.dumps(expected)
+            assert configs == original
+
+    def test_base(self):
+        base = {'a': {'b': 1}, 'c': 2}
+        result = includehandler.merge_configs([{'a': {'d': 3}}], base)
+        assert json.dumps(result) == '{"a": {"b": 1, "d": 3}, "c": 2}'
+        assert base == {'a': {'b': 1}, 'c': 2}
+
+    def test_shared_mapping(self):
+        # The same mapping may appear several times, e.g. by YAML anchors
+        shared = {'x': 1}
+        result = includehandler.merge_configs([{'a': shared, 'b': shared},
+                                               {'a': {'y': 2}}])
+        assert result == {'a': {'x': 1, 'y': 2}, 'b': {'x': 1}}
+        assert shared == {'x': 1}
+
+    def test_non_dict(self):
+        with pytest.raises(includehandler.IncludeException):
+            includehandler.merge_configs([{'a': 1}, ['b']])
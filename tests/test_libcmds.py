@@ -0,0 +1,191 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+# pylint: disable=protected-access
+
+import os
+import json
+
+import pytest
+
+from kas.libcmds import BitbakeServer, ReposLock, _write_if_changed
+from kas.repos import Repo
+
+
+def test_write_if_changed(tmpdir):
+    filename = str(tmpdir.join('local.conf'))
+    assert _write_if_changed(filename, 'MACHINE = "a"\n')
+    os.utime(filename, ns=(1000000000, 1000000000))
+
+    assert not _write_if_changed(filename, 'MACHINE = "a"\n')
+    assert os.stat(filename).st_mtime_ns == 1000000000
+
+    assert _write_if_changed(filename, 'MACHINE = "b"\n')
+    assert os.stat(filename).st_mtime_ns != 1000000000
+    assert tmpdir.join('local.conf').read() == 'MACHINE = "b"\n'
+    assert tmpdir.listdir() == [tmpdir.join('local.conf')]
+
+
+class StaticConfig(object):
+    def __init__(self, build_dir, environ):
+        self.build_dir = build_dir
+        self.environ = environ
+
+
+class TestBitbakeServer(object):
+    @pytest.fixture
+    def stops(self, monkeypatch):
+        stops = []
+        monkeypatch.setattr(BitbakeServer, '_stop',
+                            staticmethod(lambda config: stops.append(config)))
+        return stops
+
+    @staticmethod
+    def run(tmpdir, **environ):
+        build_dir = str(tmpdir.join('build'))
+        os.makedirs(os.path.join(build_dir, 'conf'), exist_ok=True)
+        config = StaticConfig(build_dir, dict(
+            PATH='/usr/bin', BB_ENV_EXTRAWHITE='MACHINE SSH_AUTH_SOCK',
+            BB_SERVER_TIMEOUT='60', **environ))
+        BitbakeServer().execute(config)
+        return os.path.join(build_dir, '.kas-bitbake-server')
+
+    def test_reuse(self, tmpdir, stops):
+        filename = self.run(tmpdir)
+        stops.clear()
+        self.run(tmpdir)
+        assert stops == []
+        assert os.path.exists(filename)
+
+    def test_changed_environment(self, tmpdir, stops):
+        self.run(tmpdir, MACHINE='qemux86')
+        stops.clear()
+        self.run(tmpdir, MACHINE='qemux86', UNRELATED='1')
+        assert stops == []
+        self.run(tmpdir, MACHINE='qemuarm')
+        assert len(stops) == 1
+
+    def test_changed_configuration(self, tmpdir, stops):
+        self.run(tmpdir)
+        stops.clear()
+        tmpdir.join('build', 'conf', 'local.conf').write('MACHINE = "x"\n')
+        self.run(tmpdir)
+        assert len(stops) == 1
+
+    def test_ssh_agent(self, tmpdir, stops):
+        self.run(tmpdir, SSH_AUTH_SOCK='/tmp/first', SSH_AGENT_PID='1')
+        stops.clear()
+        self.run(tmpdir, SSH_AUTH_SOCK='/tmp/second', SSH_AGENT_PID='2')
+        assert stops == []
+
+    def test_without_timeout(self, tmpdir, stops):
+        filename = self.run(tmpdir)
+        stops.clear()
+        config = StaticConfig(str(tmpdir.join('build')), {'PATH': '/usr/bin'})
+        BitbakeServer().execute(config)
+        assert stops == [config]
+        assert not os.path.exists(filename)
+        # There is no server of an earlier call to stop
+        BitbakeServer().execute(config)
+        assert stops == [config]
+
+    def test_stop_without_path(self, tmpdir, monkeypatch):
+        paths = []
+        monkeypatch.setattr('kas.libcmds.find_program',
+                            lambda path, name: paths.append(path))
+        tmpdir.join('bitbake.lock').write('')
+        BitbakeServer._stop(StaticConfig(str(tmpdir), {}))
+        assert paths == [os.environ['PATH']]
+
+
+class LockConfig(object):
+    def __init__(self, tmpdir):
+        self.repo_dict = {
+            'a': Repo(url='https://example.com/a.git',
+                      path=str(tmpdir.join('a')), refspec='master')}
+        self.repo_lock = None
+
+    def get_repo_dict(self):
+        return self.repo_dict
+
+    def set_repo_lock(self, repo_lock):
+        self.repo_lock = repo_lock
+
+
+class TestReposLock(object):
+    commit = 'a' * 40
+
+    @pytest.fixture
+    def resolves(self, monkeypatch):
+        resolves = []
+
+        def _repos_resolve(config, repo_dict, jobs, jobs_per_host):
+            # pylint: disable=unused-argument
+            resolves.append(sorted(repo_dict))
+            return {name: self.commit for name in repo_dict}
+
+        monkeypatch.setattr('kas.libcmds.repos_resolve', _repos_resolve)
+        return resolves
+
+    def test_create(self, tmpdir, resolves):
+        config_file = str(tmpdir.join('kas.yml'))
+        locked = {'a': {'url': 'https://example.com/a.git',
+                        'refspec': 'master', 'commit': self.commit}}
+
+        config = LockConfig(tmpdir)
+        ReposLock(config_file).execute(config)
+        assert resolves == []
+        assert config.repo_lock is None
+        assert not tmpdir.join('kas.lock').exists()
+
+        ReposLock(config_file, create=True).execute(config)
+        assert resolves == [['a']]
+        assert config.repo_lock == locked
+        with open(str(tmpdir.join('kas.lock'))) as fds:
+            assert json.load(fds) == {'repos': locked}
+
+        # An existing lock file is only read
+        config = LockConfig(tmpdir)
+        ReposLock(config_file, create=True).execute(config)
+        assert resolves == [['a']]
+        assert config.repo_lock == locked
+
+        ReposLock(config_file, update=True).execute(config)
+        assert resolves == [['a'], ['a']]
+
+    def test_unwritable(self, tmpdir, resolves):
+        # The lock file cannot be written, but the commits are still used
+        config_file = str(tmpdir.join('missing', 'kas.yml'))
+        config = LockConfig(tmpdir)
+        ReposLock(config_file, create=True).execute(config)
+        assert resolves == [['a']]
+        assert config.repo_lock['a']['commit'] == self.commit
+        assert not tmpdir.join('missing').exists()
+
+    @pytest.mark.parametrize('content', ['{', '[]', '{"repos": []}'])
+    def test_malformed(self, tmpdir, resolves, content):
+        tmpdir.join('kas.lock').write(content)
+        config = LockConfig(tmpdir)
+        ReposLock(str(tmpdir.join('kas.yml'))).execute(config)
+        assert resolves == []
+        assert config.repo_lock == {}
@@ -0,0 +1,552 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+# pylint: disable=protected-access
+
+import os
+import shutil
+import asyncio
+import subprocess
+
+import pytest
+
+from conftest import git, write
+from kas import libgit
+from kas.repos import Repo
+
+
+class StaticConfig(object):
+    def __init__(self, work_dir, ref_dir=None, worktree=False,
+                 dissociate=False):
+        self.kas_work_dir = work_dir
+        self.environ = {'PATH': os.environ['PATH']}
+        self.ref_dir = ref_dir
+        self.worktree = worktree
+        self.dissociate = dissociate
+
+    def get_repo_ref_dir(self):
+        return self.ref_dir
+
+    def get_repo_ref_worktree(self):
+        return self.worktree
+
+    def get_repo_ref_dissociate(self):
+        return self.dissociate
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def no_git(monkeypatch):
+    @asyncio.coroutine
+    def _run_cmd_async(cmd, **kwargs):
+        # pylint: disable=unused-argument
+        raise AssertionError('unexpected call of ' + ' '.join(cmd))
+
+    monkeypatch.setattr(libgit, 'run_cmd_async', _run_cmd_async)
+
+
+@pytest.mark.parametrize('refspec,expected', [
+    ('master', '+refs/heads/master:refs/remotes/origin/master'),
+    ('release/v1', '+refs/heads/release/v1:refs/remotes/origin/release/v1'),
+    ('refs/tags/v1', '+refs/tags/v1:refs/tags/v1'),
+    ('refs/heads/next', '+refs/heads/next:refs/heads/next'),
+    ('a' * 40, 'a' * 40),
+])
+def test_fetch_refspec(refspec, expected):
+    assert libgit._fetch_refspec(refspec, 'refs/remotes/origin/') == expected
+
+
+@pytest.mark.parametrize('refspec', ['next', 'v2', 'refs/tags/v2', None])
+def test_fetch_missing_refspec(remote, tmpdir, refspec):
+    path = str(tmpdir.join('work', 'repo'))
+    git(str(tmpdir), 'clone', '-q', remote, path)
+    git(remote, 'checkout', '-q', '-b', 'next')
+    write(os.path.join(remote, 'README'), 'next\n')
+    git(remote, 'commit', '-q', '-a', '-m', 'next')
+    git(remote, 'tag', '-a', '-m', 'v2', 'v2')
+    # A commit id is the commit the tag points to
+    refspec = refspec or git(remote, 'rev-parse', 'v2^{commit}')
+
+    repo = Repo(url='file://' + remote, path=path, refspec=refspec)
+    config = StaticConfig(str(tmpdir.join('work')))
+    assert run(libgit._repo_fetch_async(config, repo)) == 0
+    assert run(libgit._repo_checkout_async(config, repo)) == 0
+    assert git(path, 'rev-parse', 'HEAD') == git(remote, 'rev-parse', 'next')
+
+
+class TestResolve(object):
+    branch = 'a' * 40
+    tag = 'b' * 40
+    commit = 'c' * 40
+
+    @pytest.mark.parametrize('refspec,output,expected', [
+        ('next', '{branch}\trefs/heads/next\n', 'branch'),
+        ('v1', '{tag}\trefs/tags/v1\n', 'tag'),
+        ('v1', '{tag}\trefs/tags/v1\n{commit}\trefs/tags/v1^{{}}\n',
+         'commit'),
+        ('v1', '{branch}\trefs/heads/v1\n{tag}\trefs/tags/v1\n'
+         '{commit}\trefs/tags/v1^{{}}\n', 'commit'),
+        ('refs/heads/v1', '{branch}\trefs/heads/v1\n', 'branch'),
+        ('missing', '', None),
+    ])
+    def test_ls_remote(self, tmpdir, monkeypatch, refspec, output, expected):
+        calls = []
+
+        @asyncio.coroutine
+        def _run_cmd_async(cmd, **kwargs):
+            # pylint: disable=unused-argument
+            calls.append(cmd)
+            return (0, output.format(branch=self.branch, tag=self.tag,
+                                     commit=self.commit))
+
+        monkeypatch.setattr(libgit, 'run_cmd_async', _run_cmd_async)
+        repo = Repo(url='https://example.com/repo.git',
+                    path=str(tmpdir.join('repo')), refspec=refspec)
+        commit = run(libgit._repo_resolve_async(StaticConfig(str(tmpdir)),
+                                                repo))
+        assert commit == (getattr(self, expected) if expected else None)
+        assert calls == [['git', 'ls-remote', repo.url, refspec,
+                          refspec + '^{}']]
+
+    def test_commit_id(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(libgit, 'run_cmd_async', None)
+        repo = Repo(url='https://example.com/repo.git',
+                    path=str(tmpdir.join('repo')), refspec=self.commit)
+        assert run(libgit._repo_resolve_async(StaticConfig(str(tmpdir)),
+                                              repo)) == self.commit
+
+    def test_local(self, remote, tmpdir):
+        path = str(tmpdir.join('work', 'repo'))
+        git(str(tmpdir), 'clone', '-q', remote, path)
+        commit = git(remote, 'rev-parse', 'HEAD')
+        config = StaticConfig(str(tmpdir.join('work')))
+        repo = Repo(url='file://' + remote, path=path, refspec=commit[:10])
+        assert run(libgit._repo_resolve_async(config, repo)) == commit
+        repo.refspec = 'missing'
+        assert run(libgit._repo_resolve_async(config, repo)) is None
+
+    def test_unresolved(self, monkeypatch, tmpdir):
+        @asyncio.coroutine
+        def _resolve(config, repo):
+            # pylint: disable=unused-argument
+            return None if repo.refspec == 'missing' else self.commit
+
+        monkeypatch.setattr(libgit, '_repo_resolve_async', _resolve)
+        repo_dict = {name: Repo(url='https://example.com/repo.git',
+                                path=str(tmpdir.join(name)), refspec=name)
+                     for name in ['master', 'missing']}
+        assert libgit.repos_resolve(StaticConfig(str(tmpdir)), repo_dict) == \
+            {'master': self.commit}
+
+
+class TestCheckoutStamp(object):
+    @pytest.fixture
+    def checkout(self, remote, tmpdir):
+        path = str(tmpdir.join('work', 'repo'))
+        git(str(tmpdir), 'clone', '-q', remote, path)
+        repo = Repo(url='file://' + remote, path=path, refspec='master')
+        assert not libgit._checkout_stamp_valid(repo)
+        config = StaticConfig(str(tmpdir.join('work')))
+        assert run(libgit._repo_checkout_async(config, repo)) == 0
+        assert libgit._checkout_stamp_valid(repo)
+        return (config, repo)
+
+    def test_unchanged(self, checkout, monkeypatch):
+        (config, repo) = checkout
+        no_git(monkeypatch)
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert run(libgit._repo_checkout_async(config, repo)) == 0
+        assert libgit._checkout_stamp_valid(repo)
+
+    def test_head(self, checkout):
+        (_, repo) = checkout
+        git(repo.path, 'checkout', '-q', 'first')
+        assert not libgit._checkout_stamp_valid(repo)
+
+    def test_index(self, checkout):
+        (_, repo) = checkout
+        write(os.path.join(repo.path, 'new'), 'new\n')
+        git(repo.path, 'add', 'new')
+        assert not libgit._checkout_stamp_valid(repo)
+
+    def test_refspec(self, checkout):
+        (config, repo) = checkout
+        other = Repo(url=repo.url, path=repo.path, refspec='first')
+        assert not libgit._checkout_stamp_valid(other)
+        assert run(libgit._repo_checkout_async(config, other)) == 0
+        assert libgit._checkout_stamp_valid(other)
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(repo.path, 'rev-parse', 'first^{commit}')
+
+
+class TestFetchScheduler(object):
+    @staticmethod
+    def fetch_all(scheduler, hosts):
+        running = []
+        peaks = {'all': 0}
+
+        @asyncio.coroutine
+        def _fetch(repo):
+            running.append(repo.host)
+            peaks['all'] = max(peaks['all'], len(running))
+            peaks[repo.host] = max(peaks.get(repo.host, 0),
+                                   running.count(repo.host))
+            yield from asyncio.sleep(0.01)
+            running.remove(repo.host)
+            return repo.name
+
+        repos = [Repo(url='https://{}/repo{}.git'.format(host, index),
+                      path='/work/repo{}'.format(index), refspec='master')
+                 for (index, host) in enumerate(hosts)]
+        tasks = [libgit._ensure_future(scheduler.run(repo, _fetch, repo))
+                 for repo in repos]
+        run(asyncio.wait(tasks))
+        assert [task.result() for task in tasks] == \
+            [repo.name for repo in repos]
+        return peaks
+
+    def test_limits(self):
+        peaks = self.fetch_all(libgit.FetchScheduler(3, 2),
+                               ['a'] * 4 + ['b'] * 4 + ['c'] * 4)
+        assert peaks['all'] == 3
+        assert max(peaks[host] for host in 'abc') == 2
+
+    def test_host_limit_below_global(self):
+        # The fetches of one host do not occupy all global slots
+        peaks = self.fetch_all(libgit.FetchScheduler(4, 1),
+                               ['a'] * 4 + ['b'])
+        assert peaks['all'] == 2
+        assert peaks['a'] == 1
+
+    def test_defaults(self):
+        scheduler = libgit.FetchScheduler()
+        assert scheduler.jobs == libgit.FETCH_JOBS
+        assert scheduler.jobs_per_host == libgit.FETCH_JOBS_PER_HOST
+        assert libgit.FetchScheduler(2, 4).jobs_per_host == 2
+
+
+class TestMirror(object):
+    @staticmethod
+    def config(tmpdir, **kwargs):
+        return StaticConfig(str(tmpdir.join('work')),
+                            ref_dir=str(tmpdir.join('ref')), **kwargs)
+
+    @staticmethod
+    def repo(remote, tmpdir, refspec='master', name='repo'):
+        return Repo(url='file://' + remote,
+                    path=str(tmpdir.join('work', name)), refspec=refspec)
+
+    def test_create_and_reuse(self, remote, tmpdir):
+        config = self.config(tmpdir)
+        repo = self.repo(remote, tmpdir)
+        mirror = run(libgit._repo_mirror_async(config, repo))
+        assert mirror == str(tmpdir.join('ref', repo.qualified_name))
+        assert git(mirror, 'rev-parse', '--is-bare-repository') == 'true'
+        assert not os.path.exists(mirror + '.tmp')
+
+        # The existing mirror is updated with the refspec
+        write(os.path.join(remote, 'README'), 'third\n')
+        git(remote, 'commit', '-q', '-a', '-m', 'third')
+        assert run(libgit._repo_mirror_async(config, repo)) == mirror
+        assert git(mirror, 'rev-parse', 'master') == \
+            git(remote, 'rev-parse', 'master')
+
+    def test_unusable(self, tmpdir):
+        config = self.config(tmpdir)
+        repo = self.repo(str(tmpdir.join('missing')), tmpdir)
+        assert run(libgit._repo_mirror_async(config, repo)) is None
+        assert os.listdir(str(tmpdir.join('ref'))) == \
+            [repo.qualified_name + '.lock']
+        assert run(libgit._repo_mirror_async(StaticConfig(str(tmpdir)),
+                                             repo)) is None
+
+    @staticmethod
+    def read_only(monkeypatch):
+        # The tests run as root, which may write anywhere, so a read-only
+        # reference directory is simulated by a lock file it cannot open
+        @asyncio.coroutine
+        def _lock_file_async(filename):
+            raise PermissionError(13, 'Permission denied', filename)
+
+        monkeypatch.setattr(libgit, '_lock_file_async', _lock_file_async)
+
+    @pytest.mark.parametrize('worktree', [False, True])
+    def test_read_only(self, remote, tmpdir, monkeypatch, worktree):
+        config = self.config(tmpdir, worktree=worktree)
+        mirror = run(libgit._repo_mirror_async(config,
+                                               self.repo(remote, tmpdir)))
+        commit = git(mirror, 'rev-parse', 'master')
+        write(os.path.join(remote, 'README'), 'third\n')
+        git(remote, 'commit', '-q', '-a', '-m', 'third')
+        self.read_only(monkeypatch)
+
+        # The mirror is used without updating it, and only borrowed from
+        repo = self.repo(remote, tmpdir, name='other')
+        assert run(libgit._repo_mirror_async(config, repo)) == mirror
+        assert git(mirror, 'rev-parse', 'master') == commit
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert os.path.exists(os.path.join(repo.path, '.git', 'objects',
+                                           'info', 'alternates'))
+        assert git(repo.path, 'rev-parse', 'HEAD') == commit
+
+    def test_read_only_without_mirror(self, remote, tmpdir, monkeypatch):
+        config = self.config(tmpdir)
+        repo = self.repo(remote, tmpdir)
+        self.read_only(monkeypatch)
+        assert run(libgit._repo_mirror_async(config, repo)) is None
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert not os.path.exists(os.path.join(repo.path, '.git', 'objects',
+                                               'info', 'alternates'))
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'master')
+
+    @pytest.mark.parametrize('dissociate', [False, True])
+    def test_clone(self, remote, tmpdir, dissociate):
+        config = self.config(tmpdir, dissociate=dissociate)
+        repo = self.repo(remote, tmpdir)
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        alternates = os.path.join(repo.path, '.git', 'objects', 'info',
+                                  'alternates')
+        assert os.path.exists(alternates) != dissociate
+        assert git(repo.path, 'remote', 'get-url', 'origin') == repo.url
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'master')
+
+    def test_worktree(self, remote, tmpdir):
+        config = self.config(tmpdir, worktree=True)
+        repo = self.repo(remote, tmpdir, refspec='first')
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        mirror = str(tmpdir.join('ref', repo.qualified_name))
+        assert os.path.isfile(os.path.join(repo.path, '.git'))
+        assert git(repo.path, 'rev-parse', '--git-common-dir') == mirror
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'first^{commit}')
+
+        # A new commit is fetched into the mirror the worktree uses
+        write(os.path.join(remote, 'README'), 'third\n')
+        git(remote, 'commit', '-q', '-a', '-m', 'third')
+        commit = git(remote, 'rev-parse', 'HEAD')
+        repo = self.repo(remote, tmpdir, refspec=commit)
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert run(libgit._repo_checkout_async(config, repo)) == 0
+        assert git(repo.path, 'rev-parse', 'HEAD') == commit
+
+        # The worktree of a removed checkout is added again
+        shutil.rmtree(repo.path)
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert git(repo.path, 'rev-parse', 'HEAD') == commit
+
+    @pytest.mark.parametrize('worktree', [False, True])
+    def test_without_refspec(self, remote, tmpdir, worktree):
+        config = self.config(tmpdir, worktree=worktree)
+        repo = self.repo(remote, tmpdir, refspec=None)
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'master')
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert run(libgit._repo_checkout_async(config, repo)) == 0
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'master')
+
+
+class TestPartialClone(object):
+    @pytest.fixture
+    def config(self, remote, tmpdir):
+        git(remote, 'config', 'uploadpack.allowFilter', 'true')
+        os.makedirs(str(tmpdir.join('work')))
+        return StaticConfig(str(tmpdir.join('work')))
+
+    @staticmethod
+    def clone(config, remote, tmpdir, clone, refspec):
+        repo = Repo(url='file://' + remote,
+                    path=str(tmpdir.join('work', 'repo')), refspec=refspec,
+                    clone=clone)
+        assert run(libgit._repo_partial_clone_async(config, repo)) == 0
+        return repo
+
+    @staticmethod
+    def is_shallow(path):
+        return git(path, 'rev-parse', '--is-shallow-repository') == 'true'
+
+    def test_shallow(self, config, remote, tmpdir):
+        first = git(remote, 'rev-parse', 'first^{commit}')
+        repo = self.clone(config, remote, tmpdir, 'shallow', first)
+        assert self.is_shallow(repo.path)
+        assert git(repo.path, 'rev-parse', 'HEAD') == first
+        assert git(repo.path, 'rev-list', '--count', 'HEAD') == '1'
+
+    @pytest.mark.parametrize('clone,clone_filter', [
+        ('blobless', 'blob:none'),
+        ('treeless', 'tree:0'),
+    ])
+    @pytest.mark.parametrize('refspec', ['master', None])
+    def test_partial(self, config, remote, tmpdir, clone, clone_filter,
+                     refspec):
+        repo = self.clone(config, remote, tmpdir, clone, refspec)
+        assert git(repo.path, 'config',
+                   'remote.origin.partialclonefilter') == clone_filter
+        assert not self.is_shallow(repo.path)
+        assert git(repo.path, 'rev-parse', 'HEAD') == \
+            git(remote, 'rev-parse', 'master')
+        assert os.path.exists(os.path.join(repo.path, 'README'))
+
+    @pytest.mark.parametrize('clone,refspec', [
+        ('shallow', 'master'),
+        ('shallow', 'f' * 40),
+        ('blobless', 'missing'),
+    ])
+    def test_fallback(self, config, remote, tmpdir, clone, refspec):
+        repo = self.clone(config, remote, tmpdir, clone, refspec)
+        assert not self.is_shallow(repo.path)
+        assert subprocess.call(['git', 'config',
+                                'remote.origin.partialclonefilter'],
+                               cwd=repo.path) == 1
+        assert git(repo.path, 'rev-list', '--count', 'origin/master') == '2'
+
+    def test_deepen(self, config, remote, tmpdir):
+        second = git(remote, 'rev-parse', 'master')
+        repo = self.clone(config, remote, tmpdir, 'shallow', second)
+        first = git(remote, 'rev-parse', 'first^{commit}')
+
+        # A missing commit is fetched on its own
+        repo.refspec = first
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert self.is_shallow(repo.path)
+        git(repo.path, 'cat-file', '-e', first + '^{commit}')
+
+        # A branch needs the complete history
+        repo.refspec = 'master'
+        assert run(libgit._repo_fetch_async(config, repo)) == 0
+        assert not self.is_shallow(repo.path)
+
+
+def repos(count):
+    return [Repo(url='https://example.com/repo{}.git'.format(index),
+                 path='/work/repo{}'.format(index), refspec='master')
+            for index in range(count)]
+
+
+class TestCheckout(object):
+    @pytest.fixture
+    def peaks(self, monkeypatch):
+        running = []
+        peaks = []
+
+        @asyncio.coroutine
+        def _checkout(config, repo):
+            # pylint: disable=unused-argument
+            running.append(repo)
+            peaks.append(len(running))
+            yield from asyncio.sleep(0.01)
+            running.remove(repo)
+            return 1 if repo.name == 'repo2' and config == 'fail' else 0
+
+        monkeypatch.setattr(libgit, '_repo_checkout_async', _checkout)
+        return peaks
+
+    def test_concurrent(self, peaks):
+        libgit.repos_checkout(None, repos(6))
+        assert max(peaks) == 6
+
+    def test_jobs(self, peaks):
+        libgit.repos_checkout(None, repos(6), jobs=2)
+        assert len(peaks) == 6
+        assert max(peaks) == 2
+
+    def test_failure(self, peaks):
+        with pytest.raises(SystemExit):
+            libgit.repos_checkout('fail', repos(4))
+        # The other checkouts are not cancelled
+        assert len(peaks) == 4
+
+
+def test_fetch_checkout(monkeypatch):
+    events = []
+
+    @asyncio.coroutine
+    def _step(name, repo, delay):
+        events.append(('start ' + name, repo.name))
+        yield from asyncio.sleep(delay)
+        events.append(('end ' + name, repo.name))
+        return 0
+
+    # The fetch of repo0 takes longest
+    monkeypatch.setattr(libgit, '_repo_fetch_async',
+                        lambda config, repo: _step(
+                            'fetch', repo,
+                            0.2 if repo.name == 'repo0' else 0.01))
+    monkeypatch.setattr(libgit, '_repo_checkout_async',
+                        lambda config, repo: _step('checkout', repo, 0.01))
+    libgit.repos_fetch_checkout(None, repos(3))
+
+    assert len(events) == 12
+    for name in ['repo0', 'repo1', 'repo2']:
+        assert events.index(('end fetch', name)) < \
+            events.index(('start checkout', name))
+    # The other repos are checked out while repo0 is still fetched
+    assert events[-3:] == [('end fetch', 'repo0'),
+                           ('start checkout', 'repo0'),
+                           ('end checkout', 'repo0')]
+
+
+def test_fetch_checkout_failure(monkeypatch):
+    checkouts = []
+
+    @asyncio.coroutine
+    def _fetch(config, repo):
+        # pylint: disable=unused-argument
+        return 1 if repo.name == 'repo1' else 0
+
+    @asyncio.coroutine
+    def _checkout(config, repo):
+        # pylint: disable=unused-argument
+        checkouts.append(repo.name)
+        return 0
+
+    monkeypatch.setattr(libgit, '_repo_fetch_async', _fetch)
+    monkeypatch.setattr(libgit, '_repo_checkout_async', _checkout)
+    with pytest.raises(SystemExit):
+        libgit.repos_fetch_checkout(None, repos(3))
+    assert sorted(checkouts) == ['repo0', 'repo2']
+
+
+def test_sparse_checkout(remote, tmpdir):
+    path = str(tmpdir.join('work', 'repo'))
+    git(str(tmpdir), 'clone', '-q', remote, path)
+    config = StaticConfig(str(tmpdir.join('work')))
+
+    def checkout(sparse):
+        repo = Repo(url='file://' + remote, path=path, refspec='master',
+                    sparse=sparse)
+        assert run(libgit._repo_checkout_async(config, repo)) == 0
+        assert libgit.repo_sparse_dirs(repo) == sparse
+        return sorted(name for name in os.listdir(path) if name != '.git')
+
+    assert checkout(['meta-a']) == ['README', 'meta-a']
+    # An enabled layer is added to the checkout
+    assert checkout(['meta-a', 'meta-b']) == ['README', 'meta-a', 'meta-b']
+    # A disabled one is removed again
+    assert checkout(['meta-b']) == ['README', 'meta-b']
+    assert checkout(None) == ['README', 'meta-a', 'meta-b']
@@ -0,0 +1,149 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+# pylint: disable=protected-access
+
+import os
+import json
+import shutil
+import argparse
+
+import pytest
+
+from conftest import git, write
+from kas import libkas
+from kas.repos import Repo
+
+
+def test_positive_int():
+    assert libkas.positive_int('3') == 3
+    for value in ['0', '-1']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            libkas.positive_int(value)
+    with pytest.raises(ValueError):
+        libkas.positive_int('many')
+
+
+def test_job_arguments():
+    parser = argparse.ArgumentParser()
+    libkas.add_job_arguments(parser)
+    args = parser.parse_args(['-j', '2', '--bb-server-timeout', '-1'])
+    assert (args.jobs, args.jobs_per_host, args.bb_server_timeout) == \
+        (2, None, -1)
+    with pytest.raises(SystemExit):
+        parser.parse_args(['--jobs-per-host', '0'])
+
+
+class TestBuildEnviron(object):
+    script = """
+mkdir -p "$1/conf"
+echo sourced >> "$1/../sourced"
+export BUILDDIR="$1"
+export BBPATH="$1"
+"""
+
+    class Config(object):
+        def __init__(self, repo, refresh=False, proxy=None):
+            self.repo = repo
+            self.refresh = refresh
+            self.proxy = proxy or {}
+
+        def get_repos(self):
+            return [self.repo]
+
+        def get_environment(self):
+            return {}
+
+        def get_build_environ_refresh(self):
+            return self.refresh
+
+        def get_proxy_config(self):
+            return self.proxy
+
+    @pytest.fixture
+    def init_repo(self, tmpdir):
+        path = str(tmpdir.join('poky'))
+        write(os.path.join(path, 'oe-init-build-env'), self.script)
+        git(str(tmpdir), 'init', '-q', path)
+        git(path, 'add', '-A')
+        git(path, 'commit', '-q', '-m', 'first')
+        return Repo(url=path, path=path)
+
+    @staticmethod
+    def environ(init_repo, tmpdir, build='build', refresh=False, proxy=None):
+        build_dir = str(tmpdir.join(build))
+        env = libkas.get_build_environ(
+            TestBuildEnviron.Config(init_repo, refresh, proxy), build_dir)
+        assert env['BUILDDIR'] == build_dir
+        with open(str(tmpdir.join('sourced'))) as fds:
+            return len(fds.readlines())
+
+    def test_reuse(self, init_repo, tmpdir):
+        assert self.environ(init_repo, tmpdir) == 1
+        assert self.environ(init_repo, tmpdir) == 1
+        with open(str(tmpdir.join('build', '.kas-environ.json'))) as fds:
+            assert json.load(fds)['environ']['BBPATH'] == \
+                str(tmpdir.join('build'))
+
+    def test_refresh(self, init_repo, tmpdir):
+        assert self.environ(init_repo, tmpdir) == 1
+        assert self.environ(init_repo, tmpdir, refresh=True) == 2
+        assert self.environ(init_repo, tmpdir) == 2
+
+    def test_invalidated(self, init_repo, tmpdir):
+        assert self.environ(init_repo, tmpdir) == 1
+        # Another build directory
+        assert self.environ(init_repo, tmpdir, build='other') == 2
+        # A changed init script
+        write(os.path.join(init_repo.path, 'oe-init-build-env'),
+              self.script + 'export MACHINE=qemux86\n')
+        assert self.environ(init_repo, tmpdir) == 3
+        assert self.environ(init_repo, tmpdir) == 3
+        # A new commit of the init repository
+        git(init_repo.path, 'commit', '-q', '-a', '-m', 'second')
+        assert self.environ(init_repo, tmpdir) == 4
+        # A removed conf directory
+        shutil.rmtree(str(tmpdir.join('build', 'conf')))
+        assert self.environ(init_repo, tmpdir) == 5
+
+    def test_host_changes(self, init_repo, tmpdir, monkeypatch):
+        monkeypatch.delenv('BB_ENV_EXTRAWHITE', raising=False)
+        assert self.environ(init_repo, tmpdir) == 1
+        # Local changes in the init repository
+        write(os.path.join(init_repo.path, 'local.conf'), '')
+        assert self.environ(init_repo, tmpdir) == 2
+        assert self.environ(init_repo, tmpdir) == 2
+        # Other proxy settings
+        proxy = {'https_proxy': 'http://proxy:3128'}
+        assert self.environ(init_repo, tmpdir, proxy=proxy) == 3
+        assert self.environ(init_repo, tmpdir, proxy=proxy) == 3
+        # Another BB_ENV_EXTRAWHITE
+        monkeypatch.setenv('BB_ENV_EXTRAWHITE', 'MACHINE')
+        assert self.environ(init_repo, tmpdir, proxy=proxy) == 4
+        assert self.environ(init_repo, tmpdir, proxy=proxy) == 4
+
+    def test_damaged(self, init_repo, tmpdir):
+        assert self.environ(init_repo, tmpdir) == 1
+        tmpdir.join('build', '.kas-environ.json').write('{')
+        assert self.environ(init_repo, tmpdir) == 2
+        assert self.environ(init_repo, tmpdir) == 2
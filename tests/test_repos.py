@@ -0,0 +1,54 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring
+
+import copy
+
+import pytest
+
+from kas.repos import Repo
+
+
+@pytest.mark.parametrize('url,host', [
+    ('https://github.com/siemens/kas.git', 'github.com'),
+    ('https://user@git.example.com:8443/kas.git', 'git.example.com'),
+    ('ssh://git@Git.Example.com:22/kas.git', 'git.example.com'),
+    ('git://git.yoctoproject.org/poky', 'git.yoctoproject.org'),
+    ('git@github.com:siemens/kas.git', 'github.com'),
+    ('github.com:siemens/kas.git', 'github.com'),
+    ('file:///srv/git/kas.git', ''),
+    ('/srv/git/kas.git', ''),
+    ('../kas', ''),
+])
+def test_host(url, host):
+    assert Repo(url=url, path='/work/kas').host == host
+
+
+def test_cached_properties():
+    repo = Repo(url='https://github.com/siemens/kas.git', path='/work/kas',
+                layers=['meta-a', 'meta-b'])
+    assert repo.layers == ['/work/kas/meta-a', '/work/kas/meta-b']
+    assert repo.qualified_name == 'github.com.siemens.kas.git'
+    # The computed values are stored in the repo and copied with it
+    assert vars(repo)['layers'] is repo.layers
+    assert vars(copy.copy(repo))['layers'] == repo.layers
@@ -0,0 +1,127 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,no-self-use,redefined-outer-name
+
+import os
+import shutil
+
+import pytest
+
+from conftest import git
+from kas.repostate import RepoState, find_toplevel, get_repo_state
+
+
+@pytest.fixture
+def repo(tmpdir):
+    path = str(tmpdir.join('repo'))
+    os.mkdir(path)
+    git(path, 'init', '-q')
+    os.mkdir(os.path.join(path, 'layer'))
+    with open(os.path.join(path, 'layer', 'file'), 'w') as fds:
+        fds.write('content\n')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'first')
+    git(path, 'tag', '-a', '-m', 'tag', 'v1')
+    git(path, 'commit', '-q', '--allow-empty', '-m', 'second')
+    git(path, 'branch', 'feature', 'HEAD~1')
+    return path
+
+
+class TestRepoState(object):
+    def check_refs(self, path):
+        state = RepoState(path)
+        assert state.head() == git(path, 'rev-parse', 'HEAD')
+        assert state.head_ref() == git(path, 'symbolic-ref', 'HEAD')
+        for refspec in ['feature', 'v1', 'refs/heads/feature',
+                        git(path, 'rev-parse', 'HEAD~1')]:
+            assert state.rev_parse(refspec) == \
+                git(path, 'rev-parse', refspec)
+        assert state.rev_parse('missing') is None
+        assert state.rev_parse('0' * 40) is None
+
+    def test_loose(self, repo):
+        self.check_refs(repo)
+
+    def test_packed(self, repo):
+        git(repo, 'gc', '-q')
+        assert not os.listdir(os.path.join(repo, '.git', 'refs', 'heads'))
+        self.check_refs(repo)
+
+    def test_detached(self, repo):
+        first = git(repo, 'rev-parse', 'HEAD~1')
+        git(repo, 'checkout', '-q', first)
+        state = RepoState(repo)
+        assert state.head() == first
+        assert state.head_ref() is None
+
+    def test_alternates(self, repo, tmpdir):
+        git(repo, 'gc', '-q')
+        clone = str(tmpdir.join('clone'))
+        git(str(tmpdir), 'clone', '-q', '--shared', repo, clone)
+        state = RepoState(clone)
+        assert state.rev_parse(git(repo, 'rev-parse', 'feature'))
+        assert state.rev_parse('origin/feature') == \
+            git(repo, 'rev-parse', 'feature')
+
+    def test_worktree(self, repo, tmpdir):
+        worktree = str(tmpdir.join('worktree'))
+        git(repo, 'worktree', 'add', '-q', '--detach', worktree, 'feature')
+        state = RepoState(worktree)
+        assert state.head() == git(repo, 'rev-parse', 'feature')
+        assert state.rev_parse('v1') == git(repo, 'rev-parse', 'v1')
+
+    def test_no_repo(self, tmpdir):
+        state = RepoState(str(tmpdir))
+        assert state.head() is None
+        assert state.rev_parse('master') is None
+
+
+def test_find_toplevel(repo, tmpdir):
+    assert find_toplevel(os.path.join(repo, 'layer')) == repo
+    assert find_toplevel(repo) == repo
+    assert find_toplevel(str(tmpdir)) is None
+
+
+def test_bulk(repo):
+    state = RepoState(repo)
+    first = git(repo, 'rev-parse', 'HEAD~1')
+    assert state.has_objects([first, '0' * 40, 'v1']) == {first}
+    assert state.rev_parse_many(['feature', 'missing', first]) == \
+        {'feature': first, 'missing': None, first: first}
+
+
+def test_reused_state(repo):
+    state = get_repo_state(repo)
+    assert get_repo_state(repo) is state
+    git(repo, 'gc', '-q')
+    git(repo, 'commit', '-q', '--allow-empty', '-m', 'third')
+    git(repo, 'gc', '-q')
+    git(repo, 'tag', 'new', 'HEAD~1')
+    git(repo, 'pack-refs', '--all')
+    # New packs and packed refs are picked up by the same instance
+    assert get_repo_state(repo) is state
+    assert state.rev_parse('new') == git(repo, 'rev-parse', 'HEAD~1')
+    assert state.has_object(git(repo, 'rev-parse', 'HEAD'))
+    shutil.rmtree(os.path.join(repo, '.git'))
+    git(repo, 'init', '-q')
+    assert get_repo_state(repo) is not state
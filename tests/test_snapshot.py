@@ -0,0 +1,151 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+import io
+import os
+import hashlib
+import tarfile
+
+import pytest
+
+from conftest import git
+from kas import snapshot
+from kas.repos import Repo
+
+
+@pytest.fixture
+def repo(tmpdir):
+    path = str(tmpdir.join('work', 'repo'))
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    with open(os.path.join(path, 'file'), 'w') as fds:
+        fds.write('content\n')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'first')
+    commit = git(path, 'rev-parse', 'HEAD')
+    return Repo(url='https://example.com/repo.git', path=path,
+                refspec=commit)
+
+
+def write_checksum(filename, repo):
+    with open(filename, 'rb') as fds:
+        checksum = hashlib.sha256(fds.read()).hexdigest()
+    with open(filename + '.sha256', 'w') as fds:
+        fds.write(checksum + '\n')
+    with open(filename + '.tree', 'w') as fds:
+        fds.write(git(repo.path, 'rev-parse', 'HEAD^{tree}') + '\n')
+
+
+def test_restore_nested_path(repo, tmpdir):
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    snapshot._store(repo, filename)
+    target = Repo(url=repo.url, path=str(tmpdir.join('new', 'sub', 'repo')),
+                  refspec=repo.refspec)
+    assert snapshot._restore(target, filename)
+    assert git(target.path, 'rev-parse', 'HEAD') == repo.refspec
+
+
+@pytest.mark.parametrize('name,linkname,kind', [
+    ('../outside', '', tarfile.REGTYPE),
+    ('/tmp/outside', '', tarfile.REGTYPE),
+    ('./link', '../../outside', tarfile.SYMTYPE),
+    ('./link', '/etc/passwd', tarfile.SYMTYPE),
+    ('./hard', '../outside', tarfile.LNKTYPE),
+])
+def test_unsafe_members(repo, tmpdir, name, linkname, kind):
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    with tarfile.open(filename, 'w:gz') as tar:
+        tar.add(repo.path, arcname='.')
+        member = tarfile.TarInfo(name)
+        member.type = kind
+        member.linkname = linkname
+        tar.addfile(member, io.BytesIO())
+    write_checksum(filename, repo)
+    target = Repo(url=repo.url, path=str(tmpdir.join('new')),
+                  refspec=repo.refspec)
+    assert not snapshot._restore(target, filename)
+    assert not os.path.exists(target.path)
+    assert not os.path.exists(str(tmpdir.join('outside')))
+
+
+def test_symlink_chain(repo, tmpdir):
+    # Each symlink stays inside on its own, but together they lead out
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    with tarfile.open(filename, 'w:gz') as tar:
+        tar.add(repo.path, arcname='.')
+        for (name, linkname) in [('x/l', '..'), ('x/l/m', '..')]:
+            member = tarfile.TarInfo(name)
+            member.type = tarfile.SYMTYPE
+            member.linkname = linkname
+            tar.addfile(member)
+        data = b'escaped\n'
+        member = tarfile.TarInfo('x/l/m/ESCAPED')
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    write_checksum(filename, repo)
+    target = Repo(url=repo.url, path=str(tmpdir.join('work', 'new')),
+                  refspec=repo.refspec)
+    assert not snapshot._restore(target, filename)
+    assert not os.path.exists(target.path)
+    assert not os.path.exists(str(tmpdir.join('work', 'ESCAPED')))
+
+
+def test_inner_symlink(repo, tmpdir):
+    os.symlink('file', os.path.join(repo.path, 'link'))
+    os.makedirs(os.path.join(repo.path, 'dir'))
+    os.symlink('../link', os.path.join(repo.path, 'dir', 'link'))
+    git(repo.path, 'add', '-A')
+    git(repo.path, 'commit', '-q', '-m', 'links')
+    repo.refspec = git(repo.path, 'rev-parse', 'HEAD')
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    snapshot._store(repo, filename)
+    target = Repo(url=repo.url, path=str(tmpdir.join('new')),
+                  refspec=repo.refspec)
+    assert snapshot._restore(target, filename)
+    assert os.readlink(os.path.join(target.path, 'dir', 'link')) == '../link'
+
+
+def test_checksum_mismatch(repo, tmpdir):
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    snapshot._store(repo, filename)
+    with open(filename + '.sha256', 'w') as fds:
+        fds.write('0' * 64 + '\n')
+    target = Repo(url=repo.url, path=str(tmpdir.join('new')),
+                  refspec=repo.refspec)
+    assert not snapshot._restore(target, filename)
+    assert not os.path.exists(target.path)
+
+
+def test_tree_mismatch(repo, tmpdir):
+    filename = str(tmpdir.join('snapshot.tar.gz'))
+    snapshot._store(repo, filename)
+    with open(filename + '.tree') as fds:
+        assert fds.read().strip() == git(repo.path, 'rev-parse',
+                                         'HEAD^{tree}')
+    with open(filename + '.tree', 'w') as fds:
+        fds.write('0' * 40 + '\n')
+    target = Repo(url=repo.url, path=str(tmpdir.join('new')),
+                  refspec=repo.refspec)
+    assert not snapshot._restore(target, filename)
+    assert not os.path.exists(target.path)